@@ -0,0 +1,206 @@
+""" A cache for the results of read queries against the database. """
+
+import logging
+import re
+import threading
+from collections import Counter, OrderedDict
+
+logger = logging.getLogger("ges")
+
+
+# Tables that are written to by a SQL statement.
+_WRITTEN_TABLE = re.compile(
+    r"\b(?:insert\s+into|update|delete\s+from|copy|truncate(?:\s+table)?|"\
+    r"(?:alter|drop)\s+table(?:\s+if\s+exists)?)\s+(?:only\s+)?([a-z_][\w.]*)",
+    flags=re.IGNORECASE)
+
+# Tables that are written to by the SQL functions defined in the migrations.
+_FUNCTION_WRITES = {
+    "index_result_flags": ("result_flags", ),
+    "index_result_spectra": ("result_spectra", ),
+    "refresh_qc_aggregates": ("spectrum_aggregates", "cname_aggregates"),
+    "mark_dirty_cnames": ("dirty_cnames", ),
+}
+
+_FUNCTION_CALL = re.compile(r"\b({})\s*\(".format("|".join(_FUNCTION_WRITES)),
+    flags=re.IGNORECASE)
+
+_IDENTIFIER = re.compile(r"\b[a-z_]\w*", flags=re.IGNORECASE)
+
+# String literals and comments, which may contain any words.
+_LITERAL = re.compile(r"'(?:[^']|'')*'|--[^\n]*|/\*.*?\*/", flags=re.DOTALL)
+
+# Clauses with the word UPDATE that do not name a table to update.
+_NOT_A_TARGET = re.compile(
+    r"\bdo\s+update\s+set\b|\bfor\s+(?:no\s+key\s+)?update\b",
+    flags=re.IGNORECASE)
+
+# Row-locking clauses, which must run in the transaction that holds the locks.
+_LOCKING_CLAUSE = re.compile(
+    r"\bfor\s+(?:no\s+key\s+update|update|key\s+share|share)\b",
+    flags=re.IGNORECASE)
+
+
+def written_tables(query):
+    """
+    Return the names of the tables that a SQL statement writes to, including
+    the targets of data-modifying statements in `WITH` queries.
+
+    :param query:
+        The SQL query.
+    """
+
+    query = _NOT_A_TARGET.sub(" ", _LITERAL.sub("''", query))
+    names = set([name.split(".")[-1].lower() \
+        for name in _WRITTEN_TABLE.findall(query)])
+    for function in _FUNCTION_CALL.findall(query):
+        names.update(_FUNCTION_WRITES[function.lower()])
+    return names
+
+
+def is_read_only(query):
+    """
+    Return whether a SQL statement only reads from the database, without
+    writing to any table or locking any rows.
+
+    :param query:
+        The SQL query.
+    """
+
+    words = query.split(None, 1)
+    return len(words) > 0 and words[0].lower() in ("select", "with") \
+       and not written_tables(query) \
+       and _LOCKING_CLAUSE.search(_LITERAL.sub("''", query)) is None
+
+
+class ResultCache(object):
+
+    def __init__(self, max_bytes):
+        """
+        A least-recently-used cache of query results, bounded by the memory
+        used by the cached tables.
+
+        Each result is stored with the version of every table that its query
+        could depend on. Writes bump the versions of the tables they write to,
+        which invalidates any results that depend on those tables. Only writes
+        made through the same `Database` object are seen.
+
+        :param max_bytes:
+            The maximum number of bytes to keep in the cache.
+        """
+
+        self.max_bytes = max_bytes
+        self.hits, self.misses = (0, 0)
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._versions = Counter()
+        self._lock = threading.Lock()
+        return None
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def versions(self, query):
+        """
+        Return the current version of every table that a query could read from.
+        This should be called before the query is executed.
+
+        :param query:
+            The SQL query.
+        """
+
+        with self._lock:
+            versions = dict([(name, self._versions[name]) \
+                for name in set(_IDENTIFIER.findall(query.lower()))])
+
+            # Writes to unknown tables are counted against `None`.
+            versions[None] = self._versions[None]
+        return versions
+
+
+    def get(self, key):
+        """
+        Return a copy of a cached table, or `None` if there is no valid entry.
+
+        :param key:
+            The key for the query.
+        """
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                table, size, versions = entry
+                if any(self._versions[name] != version \
+                    for name, version in versions.items()):
+                    self._bytes -= size
+                    entry = None
+                else:
+                    # Most recently used entries are kept at the end.
+                    self._entries[key] = entry
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+        return table.copy()
+
+
+    def put(self, key, table, versions):
+        """
+        Store a table in the cache.
+
+        :param key:
+            The key for the query.
+
+        :param table:
+            The table returned by the query.
+
+        :param versions:
+            The table versions returned by `versions` before the query ran.
+        """
+
+        size = sum([column.nbytes for column in table.columns.values()])
+        if size > self.max_bytes:
+            return None
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+
+            self._entries[key] = (table.copy(), size, versions)
+            self._bytes += size
+
+            while self._bytes > self.max_bytes:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+        return None
+
+
+    def invalidate(self, query):
+        """
+        Invalidate cached results that could depend on tables written to by a
+        SQL statement. If the tables cannot be identified, everything is
+        invalidated.
+
+        :param query:
+            The SQL statement that was executed.
+        """
+
+        names = written_tables(query)
+        with self._lock:
+            if names:
+                for name in names:
+                    self._versions[name] += 1
+
+            else:
+                logger.debug("Clearing result cache after SQL query: {}"\
+                    .format(query))
+                self._versions[None] += 1
+                self._entries.clear()
+                self._bytes = 0
+        return None
@@ -1,21 +1,582 @@
 
 """ A convenience object for databases. """
 
+import atexit
+import contextlib
 import logging
 import numpy as np
+import os
 import psycopg2 as pg
+import re
+import sys
+import threading
 from astropy.table import Table
-from collections import Counter
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
 from decimal import Decimal
+from itertools import count
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 from time import time
 
+from cache import ResultCache, is_read_only
+from profiling import QueryRegistry, RepeatedQueryDetector, fingerprint
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 logger = logging.getLogger("ges")
 
+# For unique server-side cursor and prepared statement names.
+_cursor_counter = count()
+_statement_counter = count()
+
+# Placeholders (and escaped percent signs) in psycopg2-formatted SQL.
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s|%s|%%")
+
+
+def _as_prepared_sql(query):
+    """
+    Convert a psycopg2-formatted SQL query (with `%s` or `%(name)s` placeholders)
+    into the form used by `PREPARE` (with `$1`, `$2`, ... placeholders).
+
+    :param query:
+        The SQL query.
+
+    :returns:
+        The converted query, and a list of the keys (positional indices or
+        names) to take each parameter from the query values, in order.
+    """
+
+    keys = []
+    def substitute(match):
+        if match.group(0) == "%%":
+            return "%"
+
+        key = match.group(1)
+        if key is None:
+            key = len(keys)
+        elif key in keys:
+            return "${}".format(1 + keys.index(key))
+
+        keys.append(key)
+        return "${}".format(len(keys))
+
+    return (_PLACEHOLDER.sub(substitute, query), keys)
+
+# Frames from these files are skipped when identifying who ran a query.
+_INTERNAL_FILES = frozenset([os.path.splitext(path)[0] \
+    for path in (__file__, contextlib.__file__)])
+
+
+def _caller():
+    """
+    Return a description of the first function on the call stack that is not
+    part of this module.
+    """
+
+    frame = sys._getframe(1)
+    while frame is not None \
+    and os.path.splitext(frame.f_code.co_filename)[0] in _INTERNAL_FILES:
+        frame = frame.f_back
+
+    if frame is None:
+        return None
+    return "{}:{}:{}".format(os.path.basename(frame.f_code.co_filename),
+        frame.f_code.co_name, frame.f_lineno)
+
+# Cast PostgreSQL numeric types directly to floats instead of Decimals.
+_NUMERIC_AS_FLOAT = pg.extensions.new_type(pg.extensions.DECIMAL.values,
+    "NUMERIC_AS_FLOAT", lambda value, cursor: None if value is None \
+                                                   else float(value))
+
+
+# Statements are counted into this temporary table when they are pipelined.
+_PIPELINE_PREAMBLE = """CREATE TEMPORARY TABLE IF NOT EXISTS _ges_rowcounts (
+    i integer, n bigint);
+TRUNCATE _ges_rowcounts"""
+
+
+def _count_rows_sql(statement, i):
+    """
+    Wrap a single SQL statement so that the number of rows it affects (or
+    returns) is stored in the `_ges_rowcounts` temporary table.
+
+    :param statement:
+        A single INSERT, UPDATE, DELETE or SELECT statement, with any values
+        already interpolated.
+
+    :param i:
+        The index of the statement.
+    """
+
+    statement = statement.strip().rstrip(";")
+    if statement.split(None, 1)[0].lower() in ("insert", "update", "delete") \
+    and re.search(r"\breturning\b", statement, flags=re.IGNORECASE) is None:
+        statement += " RETURNING 1"
+
+    return "WITH s AS ({0}) INSERT INTO _ges_rowcounts (i, n) "\
+           "SELECT {1}, count(*) FROM s".format(statement, i)
+
+
+def _rows_to_arrays(rows):
+    """
+    Transpose rows returned from the database into a list of column arrays.
+    Numeric columns are returned as floats, with nulls as NaNs.
+
+    :param rows:
+        A list of row tuples.
+    """
+
+    arrays = []
+    for values in zip(*rows):
+        sample = next((v for v in values if v is not None), None)
+        if isinstance(sample, (Decimal, float)):
+            arrays.append(np.array(values, dtype=float))
+        else:
+            arrays.append(np.array(values))
+    return arrays
+
+
+# Column types that are fetched into typed arrays, by PostgreSQL type OID.
+_ARRAY_DTYPES = dict(
+    [(oid, float) for oid in pg.extensions.FLOAT.values] \
+  + [(oid, float) for oid in pg.extensions.DECIMAL.values] \
+  + [(oid, np.int64) for oid in pg.extensions.INTEGER.values] \
+  + [(oid, np.int64) for oid in pg.extensions.LONGINTEGER.values] \
+  + [(oid, bool) for oid in pg.extensions.BOOLEAN.values])
+
+
+def _fetch_arrays(cursor, batch_size=10000):
+    """
+    Fetch the rows of an executed query into a list of column arrays. The
+    arrays are allocated once and filled in batches of rows, so the rows are
+    never all held as tuples at the same time. Numeric columns are returned as
+    floats, with nulls as NaNs.
+
+    :param cursor:
+        A cursor that has executed a query.
+
+    :param batch_size: [optional]
+        The number of rows to convert at a time.
+    """
+
+    N = max(cursor.rowcount, 0)
+    arrays = [np.empty(N, dtype=_ARRAY_DTYPES.get(column[1], object)) \
+        for column in cursor.description]
+
+    offset = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+
+        end = offset + len(rows)
+        for i, values in enumerate(zip(*rows)):
+            # Integer and boolean columns with nulls are kept as objects.
+            if arrays[i].dtype.kind in "bi" and None in values:
+                arrays[i] = arrays[i].astype(object)
+            arrays[i][offset:end] = values
+
+        offset = end
+
+    # Give columns of strings (and other objects) their natural type.
+    return [np.array(array.tolist()) if array.dtype == object else array \
+        for array in arrays]
+
+
+def _rows_to_columns(names, rows):
+    """
+    Transpose rows returned from the database into an ordered dictionary of
+    column arrays. Numeric columns are returned as floats.
+
+    :param names:
+        The column names.
+
+    :param rows:
+        A list of row tuples.
+    """
+
+    return OrderedDict(zip(names, _rows_to_arrays(rows)))
+
+
+def _format_copy_column(values):
+    """
+    Format a column of values as strings suitable for PostgreSQL's text `COPY`
+    format. Masked (or `None`) entries are written as `\\N`.
+
+    :param values:
+        An array-like of values for a single column.
+    """
+
+    mask = np.ma.getmaskarray(values)
+    data = np.ma.getdata(values)
+    if not isinstance(data, np.ndarray):
+        data = np.array(data)
+
+    kind = data.dtype.kind
+    if kind == "f":
+        formatted = np.char.mod("%.17g", data)
+    elif kind in "iu":
+        formatted = np.char.mod("%d", data)
+    elif kind == "b":
+        formatted = np.where(data, "t", "f")
+    else:
+        if kind == "O":
+            mask = mask | np.array([v is None for v in data], dtype=bool)
+            data = np.array(["" if v is None else str(v) for v in data])
+        formatted = data.astype(str)
+        for character, escaped in (("\\", "\\\\"), ("\t", "\\t"),
+            ("\n", "\\n"), ("\r", "\\r")):
+            formatted = np.char.replace(formatted, character, escaped)
+
+    formatted = formatted.astype(object)
+    formatted[mask] = "\\N"
+    return formatted
+
 
 class Database(object):
 
-    def __init__(self, **kwargs):
-        self.connection = pg.connect(**kwargs)
+    def __init__(self, pool_size=None, instrument=False, slow_query_ms=None,
+        prepared_cache_size=100, result_cache_bytes=None, **kwargs):
+        """
+        A convenience object for a PostgreSQL database.
+
+        :param pool_size: [optional]
+            If given, keep a pool of up to this many connections, so that
+            queries can safely run from many threads at once. Otherwise a single
+            connection is used.
+
+        :param instrument: [optional]
+            Keep statistics on every query (by fingerprint) in `self.queries`,
+            and log a report of them when the process exits.
+
+        :param slow_query_ms: [optional]
+            Log queries that take at least this many milliseconds, along with
+            their query plan. This implies `instrument=True`.
+
+        :param prepared_cache_size: [optional]
+            The maximum number of prepared statements to keep on each connection
+            (see `execute`). The least recently used statements are deallocated
+            when the cache is full.
+
+        :param result_cache_bytes: [optional]
+            If given, cache the tables returned by `retrieve_table` in memory,
+            using up to this many bytes. Cached results are invalidated when
+            the tables they read from are written to through this object, so
+            this should only be used when no other process writes to the
+            database at the same time.
+
+        Other keyword arguments are passed to `psycopg2.connect`.
+        """
+
+        self.queries = None
+        if instrument or slow_query_ms is not None:
+            self.queries = QueryRegistry(slow_query_ms=slow_query_ms)
+            atexit.register(self.queries.log_report)
+
+        self.results = None
+        if result_cache_bytes is not None:
+            self.results = ResultCache(result_cache_bytes)
+
+        self._prepared = {}
+        self._prepared_cache_size = prepared_cache_size
+        self._local = threading.local()
+        if pool_size is None:
+            self._pool = None
+            self._connection = pg.connect(**kwargs)
+
+        else:
+            self._pool = ThreadedConnectionPool(1, pool_size, **kwargs)
+            self._connection = None
+
+        return None
+
+
+    @property
+    def _scopes(self):
+        """
+        The query scopes that are open on the current thread. Each thread has
+        its own scopes, so that statements from other threads are not counted.
+        """
+
+        scopes = getattr(self._local, "scopes", None)
+        if scopes is None:
+            scopes = self._local.scopes = []
+        return scopes
+
+
+    @property
+    def connection(self):
+        """
+        The database connection for the current thread.
+
+        In pooled mode a connection is checked out from the pool and pinned to
+        the current thread, until `commit`, `rollback` or `release` is called.
+        """
+
+        if self._pool is None:
+            return self._connection
+
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self._pool.getconn()
+        return connection
+
+
+    def release(self):
+        """
+        Return the connection pinned to the current thread back to the pool.
+        Anything that has not been committed is rolled back.
+        """
+
+        connection = getattr(self._local, "connection", None)
+        if self._pool is None or connection is None:
+            return None
+
+        self._local.connection = None
+        connection.rollback()
+        self._pool.putconn(connection)
+        return None
+
+
+    def commit(self):
+        """
+        Commit the transaction of the current thread. In pooled mode the
+        connection is then returned to the pool.
+        """
+
+        connection = self._connection if self._pool is None \
+            else getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.commit()
+            self.release()
+        return None
+
+
+    def rollback(self):
+        """
+        Roll back the transaction of the current thread. In pooled mode the
+        connection is then returned to the pool.
+        """
+
+        connection = self._connection if self._pool is None \
+            else getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.rollback()
+            self.release()
+        return None
+
+
+    @contextmanager
+    def transaction(self):
+        """
+        A context manager for an explicit transaction. The connection for the
+        current thread is pinned for the duration of the transaction, which is
+        committed on success and rolled back if an exception is raised.
+        """
+
+        pinned = getattr(self._local, "connection", None) is not None
+        connection = self.connection
+        try:
+            yield connection
+
+        except:
+            connection.rollback()
+            raise
+
+        else:
+            connection.commit()
+
+        finally:
+            if not pinned:
+                self.release()
+
+
+    @contextmanager
+    def _borrow(self, read_only=False):
+        """
+        Borrow a connection to run a statement on.
+
+        Statements are never committed here, with or without a pool: writes
+        stay in the transaction of the current thread until `commit` is called.
+        Without a pool, or when a connection is pinned to the current thread,
+        that connection is used. In pooled mode a write pins a connection to
+        the current thread, while a read with no pinned connection uses a
+        connection from the pool for that statement only.
+
+        :param read_only: [optional]
+            Whether the statement only reads from the database.
+        """
+
+        connection = self._connection if self._pool is None \
+            else getattr(self._local, "connection", None)
+
+        if connection is not None or not read_only:
+            yield connection or self.connection
+            return
+
+        connection = self._pool.getconn()
+        try:
+            yield connection
+
+        finally:
+            connection.rollback()
+            self._pool.putconn(connection)
+
+
+    def _instrument(self, connection, query, values, taken, rows,
+        explain=True):
+        """
+        Record statistics for a statement that was executed, and capture the
+        query plan if it was slow.
+
+        :param connection:
+            The connection that the statement was executed on.
+
+        :param query:
+            The SQL query.
+
+        :param values:
+            The values used when formatting the SQL string.
+
+        :param taken:
+            The time taken to execute the statement, in milliseconds.
+
+        :param rows:
+            The number of rows returned or affected.
+
+        :param explain: [optional]
+            Capture the query plan if the statement was slow.
+        """
+
+        if self.queries is None and not self._scopes:
+            return None
+
+        key, caller = (fingerprint(query), _caller())
+        for scope in self._scopes:
+            scope.record(key, caller, taken)
+
+        if self.queries is None:
+            return None
+
+        self.queries.record(key, taken, rows, caller)
+        if not explain or not self.queries.needs_plan(key, taken):
+            return None
+
+        # Only read statements are analysed, because EXPLAIN ANALYZE executes
+        # the statement again. The savepoint is always rolled back, so that
+        # nothing done while explaining the statement is kept.
+        explain = "EXPLAIN (ANALYZE, BUFFERS) " if is_read_only(query) \
+            else "EXPLAIN "
+
+        with connection.cursor() as cursor:
+            cursor.execute("SAVEPOINT ges_explain")
+            try:
+                cursor.execute(explain + query, values)
+                plan = "\n".join([row[0] for row in cursor.fetchall()])
+
+            except pg.Error:
+                logger.debug("Could not capture query plan for {}".format(key))
+
+            else:
+                self.queries.add_plan(key, taken, plan)
+
+            cursor.execute("ROLLBACK TO SAVEPOINT ges_explain")
+            cursor.execute("RELEASE SAVEPOINT ges_explain")
+
+        return None
+
+
+    def _invalidate(self, query):
+        """
+        Invalidate any cached results that could be affected by a statement.
+
+        :param query:
+            The SQL query that was executed.
+        """
+
+        if self.results is not None and not is_read_only(query):
+            self.results.invalidate(query)
+        return None
+
+
+    def _prepared_statement(self, connection, cursor, query, values):
+        """
+        Return the statement (and values) to execute a query as a prepared
+        statement on the given connection, preparing it first if necessary.
+
+        :param connection:
+            The connection that the statement will be executed on.
+
+        :param cursor:
+            A cursor on that connection.
+
+        :param query:
+            The SQL query, in psycopg2 format.
+
+        :param values:
+            Values to use when formatting the SQL string.
+        """
+
+        cache = self._prepared.setdefault(id(connection), OrderedDict())
+        try:
+            name, keys = cache.pop(query)
+
+        except KeyError:
+            sql, keys = _as_prepared_sql(query)
+            name = "ges_statement_{}".format(next(_statement_counter))
+            cursor.execute("PREPARE {} AS {}".format(name, sql))
+
+            if len(cache) >= self._prepared_cache_size:
+                _, (evicted_name, __) = cache.popitem(last=False)
+                cursor.execute("DEALLOCATE {}".format(evicted_name))
+
+        # Most recently used statements are kept at the end.
+        cache[query] = (name, keys)
+
+        if not keys:
+            return ("EXECUTE {}".format(name), None)
+
+        return ("EXECUTE {} ({})".format(name, ", ".join(["%s"] * len(keys))),
+            [values[key] for key in keys])
+
+
+    @contextmanager
+    def query_scope(self, name, threshold=50):
+        """
+        A context manager that detects statements that are executed more than
+        `threshold` times from the same call site within the scope, and logs a
+        summary of them when the scope exits. Scopes can be nested. Only
+        statements that are executed on the current thread are counted.
+
+        :param name:
+            A name for the scope (e.g., the pipeline stage).
+
+        :param threshold: [optional]
+            The number of executions from a single call site before a statement
+            is flagged.
+        """
+
+        scope = RepeatedQueryDetector(name, threshold=threshold)
+        self._scopes.append(scope)
+        try:
+            yield scope
+
+        finally:
+            self._scopes.remove(scope)
+            scope.log_report()
+
+
+    def close(self):
+        """ Close all connections to the database. """
+
+        if self._pool is None:
+            self._connection.close()
+        else:
+            self._pool.closeall()
         return None
 
 
@@ -36,7 +597,7 @@ class Database(object):
             tuple or dict
         """
 
-        logger.debug("Running SQL update query: {}".format(query))
+        logger.debug("Running SQL update query: %s", query)
         names, results, cursor = self.execute(query, values, **kwargs)
         return (names, results, cursor) if full_output else cursor.rowcount
         
@@ -63,7 +624,8 @@ class Database(object):
         return (names, results, cursor.rowcount) if full_output else results
 
 
-    def execute(self, query, values=None, fetch=False, **kwargs):
+    def execute(self, query, values=None, fetch=False, numeric_as_float=False,
+        prepare=False, **kwargs):
         """
         Execute some SQL from the database.
 
@@ -78,35 +640,229 @@ class Database(object):
 
         :type values:
             tuple or dict
+
+        :param fetch: [optional]
+            Fetch all of the rows returned. If a callable is given, it is called
+            with the cursor and its return value is used instead of the rows.
+
+        :param numeric_as_float: [optional]
+            Return numeric values as floats instead of `Decimal` objects.
+
+        :param prepare: [optional]
+            Run the query as a server-side prepared statement, so that it is
+            only parsed and planned once per connection. This is intended for
+            queries that are run many times with different values. Values that
+            expand to SQL lists (e.g., tuples for `IN %s`) are not supported.
         """
 
         t_init = time()
         try:
-            with self.connection.cursor() as cursor:
-                cursor.execute(query, values)
-                if fetch: results = cursor.fetchall()
+            with self._borrow(is_read_only(query)) as connection, \
+            connection.cursor() as cursor:
+                if numeric_as_float:
+                    pg.extensions.register_type(_NUMERIC_AS_FLOAT, cursor)
+                if prepare:
+                    cursor.execute(*self._prepared_statement(
+                        connection, cursor, query, values))
+                else:
+                    cursor.execute(query, values)
+                if callable(fetch): results = fetch(cursor)
+                elif fetch: results = cursor.fetchall()
                 else: results = None
 
+                taken = 1e3 * (time() - t_init)
+                self._instrument(connection, query, values, taken,
+                    cursor.rowcount)
+                self._invalidate(query)
+
         except pg.ProgrammingError:
             logger.exception("SQL query failed: {0}, {1}".format(query, values))
             cursor.close()
             raise
         
         else:
-            taken = 1e3 * (time() - t_init)
-            try:
-                logger.debug("Took {0:.0f} ms for SQL query {1}".format(taken,
-                    " ".join((query % values).split())))
-            except (TypeError, ValueError):
-                logger.debug("Took {0:.0f} ms for SQL query {1} with values {2}"\
-                    .format(taken, query, values))
+            if logger.isEnabledFor(logging.DEBUG):
+                try:
+                    logger.debug("Took {0:.0f} ms for SQL query {1}".format(
+                        taken, " ".join((query % values).split())))
+                except (TypeError, ValueError):
+                    logger.debug(
+                        "Took {0:.0f} ms for SQL query {1} with values {2}"\
+                        .format(taken, query, values))
         
         names = None if cursor.description is None \
             else tuple([column[0] for column in cursor.description])
         return (names, results, cursor)
 
 
-    def retrieve_table(self, query, values=None, prefixes=True, **kwargs):
+    def execute_many_pipelined(self, statements, page_size=100):
+        """
+        Execute many independent statements with as few network round-trips as
+        possible. Statements are sent to the server in pages of `page_size`
+        statements, and are executed in order, so each statement sees the
+        effects of those before it. Nothing is committed.
+
+        :param statements:
+            A list of `(query, values)` tuples. Each query must be a single
+            INSERT, UPDATE, DELETE or SELECT statement.
+
+        :param page_size: [optional]
+            The maximum number of statements to send in one round-trip.
+
+        :returns:
+            A list with the number of rows affected (or returned) by each
+            statement.
+        """
+
+        rowcounts = []
+        with self._borrow() as connection, connection.cursor() as cursor:
+            for start in range(0, len(statements), page_size):
+                t_init = time()
+                page = statements[start:start + page_size]
+
+                sql = [_PIPELINE_PREAMBLE]
+                for i, (query, values) in enumerate(page):
+                    statement = cursor.mogrify(query, values)
+                    if not isinstance(statement, str):
+                        statement = statement.decode(
+                            pg.extensions.encodings[connection.encoding])
+                    sql.append(_count_rows_sql(statement, i))
+                sql.append("SELECT n FROM _ges_rowcounts ORDER BY i")
+
+                cursor.execute(";\n".join(sql))
+                counts = [int(n) for n, in cursor.fetchall()]
+                rowcounts.extend(counts)
+
+                taken = 1e3 * (time() - t_init)
+                logger.debug("Took {0:.0f} ms to run {1} pipelined statements"\
+                    .format(taken, len(page)))
+
+                for (query, values), N in zip(page, counts):
+                    self._instrument(connection, query, values,
+                        taken / len(page), N, explain=False)
+                    self._invalidate(query)
+
+        return rowcounts
+
+
+    def retrieve_batches(self, query, values=None, itersize=10000,
+        as_columns=False):
+        """
+        Retrieve data from the database in batches, using a server-side cursor
+        so that only one batch is held in memory at a time.
+
+        :param query:
+            The SQL query to execute.
+
+        :param values: [optional]
+            Values to use when formatting the SQL string.
+
+        :param itersize: [optional]
+            The number of rows to fetch from the server in each batch.
+
+        :param as_columns: [optional]
+            Yield each batch as an ordered dictionary of column arrays, instead
+            of a list of row tuples.
+
+        :returns:
+            A generator that yields batches of rows.
+        """
+
+        t_init, N = time(), 0
+        name = "ges_cursor_{}".format(next(_cursor_counter))
+        with self._borrow(read_only=True) as connection:
+            with connection.cursor(name=name) as cursor:
+                cursor.itersize = itersize
+                if as_columns:
+                    pg.extensions.register_type(_NUMERIC_AS_FLOAT, cursor)
+                cursor.execute(query, values)
+
+                while True:
+                    rows = cursor.fetchmany(itersize)
+                    if not rows:
+                        break
+
+                    N += len(rows)
+                    if as_columns:
+                        names = [column[0] for column in cursor.description]
+                        yield _rows_to_columns(names, rows)
+                    else:
+                        yield rows
+
+            self._instrument(connection, query, values,
+                1e3 * (time() - t_init), N, explain=False)
+
+        logger.debug("Took {0:.0f} ms to stream {1} rows for SQL query {2}"\
+            .format(1e3 * (time() - t_init), N, query))
+
+
+    def retrieve_iter(self, query, values=None, itersize=10000):
+        """
+        Iterate over rows from the database, using a server-side cursor so that
+        only `itersize` rows are held in memory at a time.
+
+        :param query:
+            The SQL query to execute.
+
+        :param values: [optional]
+            Values to use when formatting the SQL string.
+
+        :param itersize: [optional]
+            The number of rows to fetch from the server at a time.
+        """
+
+        for rows in self.retrieve_batches(query, values, itersize=itersize):
+            for row in rows:
+                yield row
+
+
+    def copy_from(self, table, columns, data):
+        """
+        Bulk load columnar data into a table using PostgreSQL `COPY FROM STDIN`.
+
+        :param table:
+            The name of the table to load data into.
+
+        :param columns:
+            The names of the columns in the table.
+
+        :param data:
+            A sequence of column arrays, in the same order as `columns`.
+
+        :returns:
+            The number of rows copied.
+        """
+
+        if len(columns) != len(data):
+            raise ValueError("number of columns and data arrays do not match "\
+                "({} != {})".format(len(columns), len(data)))
+
+        t_init = time()
+        formatted = [_format_copy_column(column) for column in data]
+        buffer = StringIO("".join(
+            ["\t".join(row) + "\n" for row in zip(*formatted)]))
+
+        query = "COPY {} ({}) FROM STDIN".format(table, ", ".join(columns))
+        try:
+            with self._borrow() as connection, connection.cursor() as cursor:
+                cursor.copy_expert(query, buffer)
+                N = cursor.rowcount
+
+                self._instrument(connection, query, None,
+                    1e3 * (time() - t_init), N, explain=False)
+                self._invalidate(query)
+
+        except pg.DataError:
+            logger.exception("COPY failed: {}".format(query))
+            raise
+
+        logger.debug("Took {0:.0f} ms to COPY {1} rows into {2}".format(
+            1e3 * (time() - t_init), N, table))
+        return N
+
+
+    def retrieve_table(self, query, values=None, prefixes=True, fast=False,
+        prepare=False, cache=True, **kwargs):
         """
         Retrieve a named table from a database.
 
@@ -127,12 +883,46 @@ class Database(object):
 
         :type prefixes:
             tuple of str
+
+        :param fast: [optional]
+            Decode numeric values directly to floats and fill typed column
+            arrays in batches of rows, instead of converting each `Decimal`
+            value and transposing all rows in astropy. This is intended for
+            large scans.
+
+        :param prepare: [optional]
+            Run the query as a server-side prepared statement (see `execute`).
+
+        :param cache: [optional]
+            Use the result cache, if one was enabled when the database object
+            was created.
         """
 
-        names, rows, rowcount = self.retrieve(query, values, full_output=True)
+        if cache and self.results is not None and is_read_only(query):
+            key = (query, repr(values), repr(prefixes), fast,
+                repr(kwargs.get("dtype", None)))
+            table = self.results.get(key)
+            if table is not None:
+                return table
+
+            versions = self.results.versions(query)
+            table = self.retrieve_table(query, values, prefixes=prefixes,
+                fast=fast, prepare=prepare, cache=False, **kwargs)
+            if table is not None:
+                self.results.put(key, table, versions)
+            return table
+
+        if fast:
+            names, columns, cursor = self.execute(query, values,
+                fetch=_fetch_arrays, numeric_as_float=True, prepare=prepare)
+            N = cursor.rowcount
+
+        else:
+            names, rows, N = self.retrieve(query, values, full_output=True,
+                prepare=prepare)
 
         # TODO:
-        if len(rows) == 0:
+        if N == 0:
             return None
 
         counted_names = Counter(names)
@@ -149,8 +939,11 @@ class Database(object):
             names = [[n] for n in names]
             names = [".".join(p + n) for p, n in zip(prefixes, names)]
 
-        # Guess data types.
         dtype = kwargs.pop("dtype", None)
+        if fast:
+            return Table(columns, names=names, dtype=dtype)
+
+        # Guess data types.
         if dtype is None:
             dtype = []
             for i, name in enumerate(names):
@@ -193,3 +986,121 @@ class Database(object):
 
 
 
+class UpsertBuffer(object):
+
+    def __init__(self, database, table, conflict_columns, batch_size=1000,
+        interval=None):
+        """
+        A write-behind buffer that accumulates rows for a table, and writes them
+        in batches using `INSERT ... ON CONFLICT DO UPDATE`. Rows with the same
+        conflict key are merged in the buffer, so the last value given for each
+        column is the one that is written.
+
+        :param database:
+            The database to write to.
+
+        :param table:
+            The name of the table to write to.
+
+        :param conflict_columns:
+            The columns of a unique index on the table, which identify a row.
+
+        :param batch_size: [optional]
+            Write the buffered rows once this many rows are buffered.
+
+        :param interval: [optional]
+            Write the buffered rows if this many seconds have passed since they
+            were last written.
+        """
+
+        self._database = database
+        self.table = table
+        self.conflict_columns = tuple(conflict_columns)
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self._rows = OrderedDict()
+        self._last_flush = time()
+        return None
+
+
+    def __len__(self):
+        return len(self._rows)
+
+
+    def add(self, row):
+        """
+        Add a row to the buffer. The buffer will be written to the database if
+        it is full, or if `interval` seconds have passed since the last write.
+
+        :param row:
+            A dictionary with column names as keys. It must contain values for
+            all of the conflict columns.
+        """
+
+        key = tuple([row[column] for column in self.conflict_columns])
+        self._rows.setdefault(key, {}).update(row)
+
+        if len(self._rows) >= self.batch_size \
+        or (self.interval is not None \
+            and time() - self._last_flush >= self.interval):
+            self.flush()
+        return None
+
+
+    def flush(self):
+        """
+        Write all buffered rows to the database. Nothing is committed.
+
+        :returns:
+            The number of rows written.
+        """
+
+        rows, self._rows = (list(self._rows.values()), OrderedDict())
+        self._last_flush = time()
+        if not rows:
+            return 0
+
+        # Rows may have values for different sets of columns.
+        groups = OrderedDict()
+        for row in rows:
+            groups.setdefault(tuple(sorted(row.keys())), []).append(row)
+
+        t_init = time()
+        for columns, group in groups.items():
+            t_group = time()
+            updates = [column for column in columns \
+                if column not in self.conflict_columns]
+
+            query = "INSERT INTO {table} ({columns}) VALUES %s "\
+                    "ON CONFLICT ({conflict_columns}) {action}".format(
+                        table=self.table, columns=", ".join(columns),
+                        conflict_columns=", ".join(self.conflict_columns),
+                        action="DO UPDATE SET {}".format(", ".join(
+                            ["{0} = EXCLUDED.{0}".format(column) \
+                                for column in updates])) if updates \
+                            else "DO NOTHING")
+
+            # The rows are only committed by `commit`, so the connection must
+            # be the same one for every statement.
+            with self._database._borrow() as connection, \
+            connection.cursor() as cursor:
+                execute_values(cursor, query,
+                    [tuple([row[column] for column in columns]) \
+                        for row in group], page_size=self.batch_size)
+
+                self._database._instrument(connection, query, None,
+                    1e3 * (time() - t_group), len(group), explain=False)
+            self._database._invalidate(query)
+
+        logger.info("Wrote {} buffered rows to {} in {:.0f} ms".format(
+            len(rows), self.table, 1e3 * (time() - t_init)))
+        return len(rows)
+
+
+    def commit(self):
+        """ Write all buffered rows to the database, and commit. """
+
+        N = self.flush()
+        self._database.commit()
+        return N
@@ -0,0 +1,187 @@
+""" A compact in-memory index of the flags given to node results. """
+
+import logging
+import numpy as np
+import scipy.sparse
+
+logger = logging.getLogger("ges")
+
+
+class FlagIndex(object):
+
+    def __init__(self, row_ids, flag_row_ids, flags, cnames=None,
+        node_ids=None):
+        """
+        A sparse index of flags. Each distinct flag is mapped to an integer
+        code, and the flags of each row (e.g., a result or a star) are stored
+        as one row of a compressed sparse row (CSR) matrix of rows by flags.
+
+        :param row_ids:
+            The unique identifiers of the rows to index (e.g., result ids).
+
+        :param flag_row_ids:
+            The row identifier for each flag given.
+
+        :param flags:
+            The flag (e.g., an issue code) for each flag given.
+
+        :param cnames: [optional]
+            The CNAME of each row.
+
+        :param node_ids: [optional]
+            The node identifier of each row.
+        """
+
+        self.row_ids = np.asarray(row_ids)
+        self.cnames = None if cnames is None else np.asarray(cnames)
+        self.node_ids = None if node_ids is None else np.asarray(node_ids)
+
+        flag_row_ids = np.asarray(flag_row_ids)
+        self.flags, codes = np.unique(np.asarray(flags), return_inverse=True)
+
+        rows = np.zeros(flag_row_ids.size, dtype=int)
+        if flag_row_ids.size > 0:
+            order = np.argsort(self.row_ids)
+            positions = np.searchsorted(self.row_ids, flag_row_ids,
+                sorter=order)
+            if self.row_ids.size == 0 \
+            or np.any(positions == self.row_ids.size) \
+            or np.any(self.row_ids[order[np.minimum(positions,
+                self.row_ids.size - 1)]] != flag_row_ids):
+                raise ValueError("flags given for rows that are not indexed")
+            rows = order[positions]
+
+        matrix = scipy.sparse.csr_matrix(
+            (np.ones(rows.size, dtype=np.int32), (rows, codes)),
+            shape=(self.row_ids.size, self.flags.size))
+
+        # A flag given more than once to the same row is only counted once.
+        matrix.sum_duplicates()
+        matrix.data[:] = 1
+        self.matrix = matrix
+        self._columns = None
+        return None
+
+
+    def __len__(self):
+        return self.row_ids.size
+
+
+    @classmethod
+    def from_database(cls, database, kind="tech", column="issue_code",
+        wg=None):
+        """
+        Index the flags given to node results.
+
+        :param database:
+            A database for transactions.
+
+        :param kind: [optional]
+            The kind of flag to index: 'tech', 'peculi', or 'remark'.
+
+        :param column: [optional]
+            The column of the `result_flags` table that identifies a flag:
+            'issue_code', 'node_code', 'suffix', or 'raw'.
+
+        :param wg: [optional]
+            Only index results from this working group.
+        """
+
+        if column not in ("issue_code", "node_code", "suffix", "raw"):
+            raise ValueError("unknown flag column '{}'".format(column))
+
+        kwds = dict(kind=kind.lower(), wg=wg)
+        results = database.retrieve_table(
+            """ SELECT  r.id, r.cname, r.node_id
+                  FROM  results AS r, nodes AS n
+                 WHERE  r.node_id = n.id
+                   AND  (%(wg)s::integer IS NULL OR n.wg = %(wg)s::integer)""",
+            kwds, fast=True)
+        flags = database.retrieve_table(
+            """ SELECT  f.result_id, f.{column} AS flag
+                  FROM  result_flags AS f, results AS r, nodes AS n
+                 WHERE  f.result_id = r.id
+                   AND  r.node_id = n.id
+                   AND  f.kind = %(kind)s
+                   AND  f.{column} IS NOT NULL
+                   AND  (%(wg)s::integer IS NULL OR n.wg = %(wg)s::integer)"""\
+                .format(column=column), kwds, fast=True)
+
+        if results is None:
+            return cls([], [], [], cnames=[], node_ids=[])
+
+        if flags is None:
+            flag_result_ids, flag_values = ([], [])
+        else:
+            flag_result_ids, flag_values = (flags["result_id"], flags["flag"])
+
+        index = cls(results["id"], flag_result_ids, flag_values,
+            cnames=results["cname"], node_ids=results["node_id"])
+        logger.info("Indexed {} {} flags ({} distinct) for {} results".format(
+            index.matrix.nnz, kind, index.flags.size, len(index)))
+        return index
+
+
+    def code(self, flag):
+        """
+        Return the integer code of a flag, or `None` if it is not indexed.
+
+        :param flag:
+            The flag.
+        """
+
+        code = np.searchsorted(self.flags, flag)
+        if code < self.flags.size and self.flags[code] == flag:
+            return int(code)
+        return None
+
+
+    def mask(self, flag):
+        """
+        Return a boolean mask of the rows that have a flag.
+
+        :param flag:
+            The flag.
+        """
+
+        mask = np.zeros(len(self), dtype=bool)
+        code = self.code(flag)
+        if code is not None:
+            if self._columns is None:
+                self._columns = self.matrix.tocsc()
+            indptr = self._columns.indptr
+            mask[self._columns.indices[indptr[code]:indptr[code + 1]]] = True
+        return mask
+
+
+    def rows_with(self, flag):
+        """
+        Return the identifiers of the rows that have a flag.
+
+        :param flag:
+            The flag.
+        """
+
+        return self.row_ids[self.mask(flag)]
+
+
+    def counts(self, mask=None):
+        """
+        Return the number of rows that have each flag (in the order of
+        `flags`).
+
+        :param mask: [optional]
+            A boolean mask of the rows to count.
+        """
+
+        matrix = self.matrix if mask is None else self.matrix[np.asarray(mask)]
+        return np.asarray(matrix.sum(axis=0)).flatten()
+
+
+    def cooccurrence(self):
+        """
+        Return a sparse matrix of the number of rows that have each pair of
+        flags. The diagonal is the number of rows that have each flag.
+        """
+
+        return self.matrix.T.dot(self.matrix).tocsr()
@@ -2,9 +2,14 @@
 """ A specialized database class for Gaia-ESO Survey data releases. """
 
 import logging
+import multiprocessing as mp
 import numpy as np
+import os
 from astropy.io import fits
 from astropy.table import Table
+from collections import OrderedDict
+from functools import partial
+from time import time
 
 import utils
 from db import Database
@@ -12,9 +17,72 @@ from db import Database
 logger = logging.getLogger("ges")
 
 
-_adapt_str_to_float = lambda a: np.array(
-    [str(item).replace("NULL", "NaN").replace("--", "NaN") for item in a],
-    dtype=float)
+def _adapt_str_to_float(a):
+    values = np.char.strip(np.array(a, dtype=str))
+    return np.where(np.in1d(values, ("NULL", "--", "")), "NaN", values)\
+        .astype(float)
+
+
+def _adapt_nan(a):
+    return np.nan * np.ones(len(a))
+
+
+def _adapt_str(a):
+    return np.array(a, dtype=str)
+
+
+def _strip_strings(values):
+    """
+    Strip leading and trailing whitespace from an array of strings, keeping any
+    mask. Arrays of other types are returned unchanged.
+
+    :param values:
+        An array of values.
+    """
+
+    if getattr(values, "dtype", None) is None or values.dtype.kind not in "SU":
+        return values
+
+    stripped = np.char.strip(np.asarray(values))
+    if np.ma.isMaskedArray(values):
+        return np.ma.array(stripped, mask=np.ma.getmaskarray(values))
+    return stripped
+
+
+def _unique_key_rows(keys, keep="last"):
+    """
+    Return the (sorted) indices of the rows to keep so that each key appears
+    only once.
+
+    :param keys:
+        An array of keys.
+
+    :param keep: [optional]
+        Keep the 'first' or the 'last' row given for each key.
+    """
+
+    keys = np.asarray(keys)
+    if keep == "first":
+        _, indices = np.unique(keys, return_index=True)
+
+    elif keep == "last":
+        _, indices = np.unique(keys[::-1], return_index=True)
+        indices = keys.size - 1 - indices
+
+    else:
+        raise ValueError("keep must be 'first' or 'last'")
+
+    return np.sort(indices)
+
+
+# Node-specific operations that can be given in the adapters file. These are
+# module-level functions so that compiled adapters can be sent to worker
+# processes.
+_FORMAT_ADAPTER_OPERATIONS = {
+    "str_to_float": _adapt_str_to_float,
+    "nan": _adapt_nan,
+    "str": _adapt_str,
+}
 
 
 _FITS_FORMAT_ADAPTERS = {
@@ -105,10 +173,127 @@ _FITS_FORMAT_ADAPTERS = {
     }
 
 
+def _compile_format_adapters(node_adapters=None):
+    """
+    Compile the format adapters for a node into a list of column names and the
+    functions to apply to each column, in order. Any node-specific operations
+    are applied before the default dtypes in `_FITS_FORMAT_ADAPTERS`.
+
+    :param node_adapters: [optional]
+        A dictionary with operation names (e.g., 'str_to_float') as keys, and a
+        list of column names for each operation.
+    """
+
+    compiled = OrderedDict()
+    for operation, keys in (node_adapters or {}).items():
+        try:
+            f = _FORMAT_ADAPTER_OPERATIONS[operation]
+        except KeyError:
+            raise ValueError("unknown format adapter '{}' (available: {})"\
+                .format(operation, ", ".join(_FORMAT_ADAPTER_OPERATIONS)))
+
+        for key in keys:
+            compiled.setdefault(key.upper(), []).append(f)
+
+    for key, dtype in _FITS_FORMAT_ADAPTERS.items():
+        compiled.setdefault(key.upper(), []).append(
+            partial(np.asarray, dtype=dtype))
+
+    return list(compiled.items())
+
+
+def _compile_node_format_adapters(adapters=None):
+    """
+    Compile the format adapters for many nodes at once.
+
+    :param adapters: [optional]
+        A dictionary of node-specific format adapters, keyed by node name
+        (e.g., as read from `adapters.yaml`).
+
+    :returns:
+        A dictionary of compiled adapters keyed by node name, where the `None`
+        key holds the default adapters for any other node.
+    """
+
+    compiled = dict([(node_name, _compile_format_adapters(node_adapters)) \
+        for node_name, node_adapters in (adapters or {}).items()])
+    compiled[None] = _compile_format_adapters()
+    return compiled
+
+
+def _apply_format_adapters(data, adapters):
+    """
+    Apply compiled format adapters to a table, replacing columns in place.
+
+    :param data:
+        An astropy table.
+
+    :param adapters:
+        The compiled adapters from `_compile_format_adapters`.
+    """
+
+    for column, functions in adapters:
+        values = data[column]
+        for f in functions:
+            values = f(values)
+        data.replace_column(column, values)
+
+    return data
+
+
 class GESDatabase(Database):
 
     def __init__(self, *args, **kwargs):
         super(GESDatabase, self).__init__(*args, **kwargs)
+        self._node_registry = None
+
+
+    @property
+    def node_registry(self):
+        """
+        Return a cached registry of the nodes in the database, as a tuple of two
+        dictionaries: node id -> (wg, name), and (wg, lowercased name) -> id.
+
+        The registry is loaded on first use, and reloaded after nodes have been
+        created or deleted.
+        """
+
+        registry = self._node_registry
+        if registry is None:
+            names, ids = ({}, {})
+            for node_id, wg, name in self.retrieve(
+                "SELECT id, wg, name FROM nodes"):
+                name = name.strip()
+                names[int(node_id)] = (int(wg), name)
+                ids[(int(wg), name.lower())] = int(node_id)
+
+            registry = self._node_registry = (names, ids)
+        return registry
+
+
+    def invalidate_node_registry(self):
+        """ Discard the cached node registry. """
+        self._node_registry = None
+
+
+    def retrieve_node_name(self, node_id):
+        """
+        Retrieve the working group and name of a node.
+
+        :param node_id:
+            The identifier of the node.
+
+        :raises UnknownNodeError:
+            If no node exists.
+
+        :returns:
+            A two-length tuple containing the working group and node name.
+        """
+
+        try:
+            return self.node_registry[0][int(node_id)]
+        except KeyError:
+            raise UnknownNodeError("node does not exist")
 
 
     def create_or_retrieve_node_id(self, wg, node_name):
@@ -146,14 +331,18 @@ class GESDatabase(Database):
             The identifier.
         """
 
-        result = self.retrieve("""SELECT id FROM nodes
-            WHERE wg = %s AND lower(name) = %s""",
-            (utils.wg_as_int(wg), node_name.strip().lower(), ))
+        key = (utils.wg_as_int(wg), node_name.strip().lower())
+        try:
+            return self.node_registry[1][key]
 
-        if not result:
-            raise UnknownNodeError("node does not exist")
-        else:
-            return int(result[0][0])
+        except KeyError:
+            # Another process may have created the node since we loaded the
+            # registry, so check once more before giving up.
+            self.invalidate_node_registry()
+            try:
+                return self.node_registry[1][key]
+            except KeyError:
+                raise UnknownNodeError("node does not exist")
 
 
     def _create_node(self, wg, node_name):
@@ -174,13 +363,193 @@ class GESDatabase(Database):
             """INSERT INTO nodes (wg, name) VALUES (%s, %s) RETURNING id""",
             (wg, node_name), fetch=True)
         node_id = int(result[1][0][0])
+        self.invalidate_node_registry()
 
         logger.info("Created node '{}' in WG{} with id {}".format(
             node_name, wg, node_id))
         return node_id
 
 
-    def ingest_recommended_results_from_previous_dr(self, filename, extension=-1):
+    def delete_nodes(self, node_ids):
+        """
+        Delete nodes from the database. Nothing is committed.
+
+        :param node_ids:
+            The identifiers of the nodes to delete.
+
+        :returns:
+            The number of nodes deleted.
+        """
+
+        node_ids = list(map(int, node_ids))
+        if not node_ids:
+            return 0
+
+        N = self.update("DELETE FROM nodes WHERE id = ANY(%s)", (node_ids, ))
+        self.invalidate_node_registry()
+        return N
+
+
+    def _begin_ingest(self, filename, table, force=False):
+        """
+        Check a file against the ingest manifest before it is ingested.
+
+        If the file has been ingested before and it has not changed, then `None`
+        is returned and the file should be skipped. Otherwise any rows that were
+        previously ingested from this file are deleted from `table`, and the
+        manifest identifier to store with the new rows is returned. Nothing is
+        committed here: the caller commits once the new rows are in.
+
+        :param filename:
+            The local path of the file to be ingested.
+
+        :param table:
+            The table that rows from this file are ingested into.
+
+        :param force: [optional]
+            Re-ingest the file even if it has not changed.
+        """
+
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+
+        record = self.retrieve(
+            """ SELECT id, size, mtime, sha1
+                  FROM ingest_manifest
+                 WHERE path = %s""", (path, ))
+
+        if not record:
+            ingest_id = int(self.retrieve(
+                """ INSERT INTO ingest_manifest (path, tablename, size, mtime, sha1)
+                    VALUES (%s, %s, %s, %s, %s) RETURNING id""",
+                (path, table, stat.st_size, stat.st_mtime,
+                    utils.file_hash(path)))[0][0])
+            return ingest_id
+
+        ingest_id, size, mtime, sha1 = record[0]
+        if not force and size == stat.st_size and mtime == stat.st_mtime:
+            logger.info("Skipping unchanged file {}".format(filename))
+            return None
+
+        content_hash = utils.file_hash(path)
+        if not force and content_hash == sha1.strip():
+            logger.info("Skipping unchanged file {} (only the modification "\
+                "time has changed)".format(filename))
+            self.update(
+                "UPDATE ingest_manifest SET mtime = %s WHERE id = %s",
+                (stat.st_mtime, ingest_id))
+            self.commit()
+            return None
+
+        if table == "results":
+            # Stars that lose results need quality control to be re-run.
+            self.execute(
+                """ SELECT mark_dirty_cnames(ARRAY(
+                        SELECT DISTINCT cname FROM results
+                         WHERE ingest_id = %s))""", (ingest_id, ))
+
+        N = self.update("DELETE FROM {} WHERE ingest_id = %s".format(table),
+            (ingest_id, ))
+        logger.info("Removed {} rows from {} that were previously ingested "\
+            "from {}".format(N, table, filename))
+
+        self.update(
+            """ UPDATE ingest_manifest
+                   SET tablename = %s, size = %s, mtime = %s, sha1 = %s,
+                       n_rows = NULL, ingested = now()
+                 WHERE id = %s""",
+            (table, stat.st_size, stat.st_mtime, content_hash, ingest_id))
+        return int(ingest_id)
+
+
+    def _finish_ingest(self, ingest_id, N):
+        """
+        Record the number of rows ingested from a file in the ingest manifest.
+
+        :param ingest_id:
+            The manifest identifier returned by `_begin_ingest`.
+
+        :param N:
+            The number of rows ingested.
+        """
+
+        return self.update(
+            "UPDATE ingest_manifest SET n_rows = %s WHERE id = %s",
+            (N, ingest_id))
+
+
+    def patch_from_reference(self, table, key, columns, data, constraint=None,
+        keep="last"):
+        """
+        Update columns of a table from a reference table of values, using a
+        single `UPDATE ... FROM` join. The reference values are loaded into a
+        temporary table with `COPY`. Nothing is committed.
+
+        :param table:
+            The name of the table to update.
+
+        :param key:
+            The column name to join the reference values on (e.g., cname).
+
+        :param columns:
+            The names of the columns to update.
+
+        :param data:
+            A sequence of arrays: one for the `key`, followed by one for each of
+            the `columns`.
+
+        :param constraint: [optional]
+            An additional SQL constraint on the rows to update. The table being
+            updated is aliased as `t`, and the reference table as `p`.
+
+        :param keep: [optional]
+            If a key is given more than once, use the 'first' or the 'last'
+            values given for it.
+
+        :returns:
+            The number of rows updated.
+        """
+
+        columns = list(columns)
+        reference = "_patch_{}".format(table)
+
+        # Keep only one reference row for each key, because UPDATE ... FROM
+        # would use an arbitrary one of the matching rows.
+        data = [_strip_strings(np.asanyarray(values)) for values in data]
+        indices = _unique_key_rows(data[0], keep)
+        if indices.size < len(data[0]):
+            logger.info("Ignoring {} reference rows with duplicate keys for {}"\
+                .format(len(data[0]) - indices.size, table))
+            data = [values[indices] for values in data]
+
+        self.execute("DROP TABLE IF EXISTS {}".format(reference))
+        self.execute(
+            """ CREATE TEMPORARY TABLE {reference} ON COMMIT DROP AS
+                SELECT {columns} FROM {table} LIMIT 0""".format(
+                reference=reference, table=table,
+                columns=", ".join([key] + columns)))
+
+        self.copy_from(reference, [key] + columns, data)
+        self.execute("ANALYZE {}".format(reference))
+
+        N = self.update(
+            """ UPDATE {table} AS t
+                   SET {assignments}
+                  FROM {reference} AS p
+                 WHERE t.{key} = p.{key} {constraint}""".format(
+                table=table, reference=reference, key=key,
+                assignments=", ".join(
+                    ["{0} = p.{0}".format(column) for column in columns]),
+                constraint="" if constraint is None \
+                              else "AND {}".format(constraint)))
+
+        logger.info("Patched {} rows in {} from {} reference values".format(
+            N, table, len(data[0])))
+        return N
+
+
+    def ingest_recommended_results_from_previous_dr(self, filename, extension=-1,
+        force=False):
         """
         Ingest recommended results from a node FITS file.
 
@@ -190,10 +559,18 @@ class GESDatabase(Database):
         :param extension: [optional]
             The extension index to read from.
 
+        :param force: [optional]
+            Re-ingest the file even if the ingest manifest shows that it has
+            not changed since it was last ingested.
+
         :returns:
             The number of rows inserted.
         """
 
+        ingest_id = self._begin_ingest(filename, "recommended_idr4", force)
+        if ingest_id is None:
+            return 0
+
         image = fits.open(filename)
         data = image[extension].data
 
@@ -215,25 +592,29 @@ class GESDatabase(Database):
         N = len(data)
         for i, row in enumerate(data):
             logger.info("Ingesting recommended row {}/{}".format(i, N))
-            row_data = {}
+            row_data = {"ingest_id": ingest_id}
             for column in columns:
                 value = row[column]
                 f = fits_format_adapters.get(column, None)
                 if f is not None:
                     value = f(value)
+                elif isinstance(value, str):
+                    value = value.strip()
                 row_data[column] = value
 
             self.execute(
                 "INSERT INTO recommended_idr4 ({}) VALUES ({})".format(
-                    ", ".join(columns),
-                    ", ".join(["%({})s".format(column) for column in columns])),
+                    ", ".join(row_data.keys()),
+                    ", ".join(["%({})s".format(column) for column in row_data])),
                 row_data)
 
-        self.connection.commit()
+        self._finish_ingest(ingest_id, N)
+        self.commit()
         return N
 
 
-    def ingest_node_results(self, filename, extension=-1):
+    def ingest_node_results(self, filename, extension=-1, bulk=True,
+        adapters=None, force=False, compiled_adapters=None):
         """
         Ingest results from a node FITS file.
 
@@ -243,6 +624,22 @@ class GESDatabase(Database):
         :param extension: [optional]
             The extension index to read from.
 
+        :param bulk: [optional]
+            Load all rows with a single `COPY FROM STDIN`, instead of running
+            one `INSERT` per row.
+
+        :param adapters: [optional]
+            A dictionary of node-specific format adapters, keyed by node name
+            (e.g., as read from `adapters.yaml`).
+
+        :param force: [optional]
+            Re-ingest the file even if the ingest manifest shows that it has
+            not changed since it was last ingested.
+
+        :param compiled_adapters: [optional]
+            Format adapters that have already been compiled for many nodes (see
+            `_compile_node_format_adapters`). If given, `adapters` is ignored.
+
         :returns:
             The number of rows inserted.
         """
@@ -253,11 +650,34 @@ class GESDatabase(Database):
         uves_node_id = self.retrieve_node_id(wg, "UVES-{}".format(node_name))
         giraffe_node_id = self.retrieve_node_id(wg, "GIRAFFE-{}".format(node_name))
 
+        # Nodes are re-created with new identifiers after they have been removed
+        # (e.g., by quality control), so point any previously ingested results
+        # at the current nodes instead of re-ingesting the file.
+        N_moved = self.update(
+            """ UPDATE  results AS r
+                   SET  node_id = CASE WHEN r.setup = 'UVES' THEN %(uves)s
+                                       ELSE %(giraffe)s END
+                  FROM  ingest_manifest AS m
+                 WHERE  m.path = %(path)s
+                   AND  r.ingest_id = m.id
+                   AND  r.setup IN ('UVES', 'GIRAFFE')
+                   AND  r.node_id NOT IN (%(uves)s, %(giraffe)s)""",
+            dict(path=os.path.abspath(filename), uves=uves_node_id,
+                giraffe=giraffe_node_id))
+        if N_moved > 0:
+            logger.info("Moved {} results from {} to re-created nodes".format(
+                N_moved, filename))
+
+        ingest_id = self._begin_ingest(filename, "results", force)
+        if ingest_id is None:
+            self.commit()
+            return 0
+
         # Start ingesting results.
         data = Table.read(filename, hdu=extension)
 
         #default_row = {"node_id": node_id}
-        default_row = {"node_id": -1}
+        default_row = {"node_id": -1, "ingest_id": ingest_id}
         columns = (
             "node_id", "cname", "filename", "setup", "snr",
             "vel", "e_vel", "vrot", "e_vrot",
@@ -269,38 +689,23 @@ class GESDatabase(Database):
             "alpha_fe", "e_alpha_fe", "nn_alpha_fe", "enn_alpha_fe", "nne_alpha_fe",
             "vrad", "e_vrad", "vsini", "e_vsini",
             "peculi", "remark", "tech")
+        insert_columns = columns + ("ingest_id", )
 
         # Update formats, as necessary.
-        tmp_key_format = "{}_NEW_DTYPE"
-        for key, new_dtype in _FITS_FORMAT_ADAPTERS.items():
-
-            # FUCK THESE IDIOTIC PEOPLE WHAT THE FUCK IS WRONG WITH THEM
-            if node_name == "Carmela-Elena":
-
-                if key in ("teff", "e_teff", "logg"):
-                    data[tmp_key_format.format(key.upper())] = _adapt_str_to_float(data[key.upper()])
-                    del data[key.upper()]
-                    data.rename_column(tmp_key_format.format(key.upper()), key.upper())
-
-                elif key in ("feh", "e_feh"):
-                    del data[key.upper()]
-                    data[tmp_key_format.format(key.upper())] = np.nan * np.ones(len(data))
-                    data.rename_column(tmp_key_format.format(key.upper()), key.upper())
-
-                elif key in ("tech", "peculi", "remark"):
-                    del data[key.upper()]
-                    data[tmp_key_format.format(key.upper())] = [""] * len(data)
-                    data.rename_column(tmp_key_format.format(key.upper()), key.upper())
-
-
-            elif node_name == "Porto" and key in ("teff", "e_teff", "feh", "e_feh"):
-                data[tmp_key_format.format(key.upper())] = _adapt_str_to_float(data[key.upper()])
-                del data[key.upper()]
-                data.rename_column(tmp_key_format.format(key.upper()), key.upper())
+        if compiled_adapters is None:
+            compiled = _compile_format_adapters(
+                (adapters or {}).get(node_name, None))
+        else:
+            compiled = compiled_adapters.get(node_name, compiled_adapters[None])
+        _apply_format_adapters(data, compiled)
 
-            data[tmp_key_format.format(key.upper())] = np.array(data[key.upper()], dtype=new_dtype)
-            del data[key.upper()]
-            data.rename_column(tmp_key_format.format(key.upper()), key.upper())
+        if bulk:
+            N = self._copy_node_results(data, columns, wg, node_name,
+                uves_node_id, giraffe_node_id, ingest_id)
+            self._index_results(ingest_id)
+            self._finish_ingest(ingest_id, N)
+            self.commit()
+            return N
 
         N = len(data)
         for i, row in enumerate(data):
@@ -310,9 +715,14 @@ class GESDatabase(Database):
             row_data.update(default_row)
             row_data.update(dict(zip(columns[1:], [row[c.upper()] for c in columns[1:]])))
 
-            if row_data["setup"].strip() == "UVES":
+            # Trim strings!
+            for k in row_data.keys():
+                if isinstance(row_data[k], str):
+                    row_data[k] = row_data[k].strip()
+
+            if row_data["setup"] == "UVES":
                 row_data["node_id"] = uves_node_id
-            elif row_data["setup"].strip() == "GIRAFFE":
+            elif row_data["setup"] == "GIRAFFE":
                 row_data["node_id"] = giraffe_node_id
             else:
                 raise WTFError
@@ -321,7 +731,7 @@ class GESDatabase(Database):
                 for key in ("tech", "peculi", "remark"):
                     row_data[key] = str(row_data[key])
 
-                use_columns = [] + list(columns)
+                use_columns = list(insert_columns)
                 for k in row_data.keys():
                     if isinstance(row_data[k], (bool, np.bool_)):
                         del row_data[k]
@@ -336,27 +746,138 @@ class GESDatabase(Database):
             else:
                 self.execute(
                     "INSERT INTO results ({}) VALUES ({})".format(
-                        ", ".join(columns),
-                        ", ".join(["%({})s".format(column) for column in columns])),
+                        ", ".join(insert_columns),
+                        ", ".join(["%({})s".format(column) \
+                            for column in insert_columns])),
                     row_data)
 
-        self.connection.commit()
+        self._index_results(ingest_id)
+        self._finish_ingest(ingest_id, N)
+        self.commit()
+        return N
+
+
+    def _index_results(self, ingest_id):
+        """
+        Parse the TECH, PECULI and REMARK flags of newly ingested results into
+        the `result_flags` table, and their spectrum filenames into the
+        `result_spectra` table, then queue the stars they belong to for quality
+        control. Nothing is committed.
+
+        The quality control aggregates are not refreshed here, because files
+        are ingested in parallel transactions that share stars and spectra.
+        They are refreshed for the queued stars once the ingest is complete.
+
+        :param ingest_id:
+            The ingest manifest identifier of the results.
+
+        :returns:
+            A two-length tuple containing the number of flags and the number of
+            spectrum filenames found.
+        """
+
+        N_flags, N_spectra = self.retrieve(
+            "SELECT index_result_flags(%s), index_result_spectra(%s)",
+            (ingest_id, ingest_id))[0]
+        self.execute(
+            """ SELECT mark_dirty_cnames(ARRAY(
+                    SELECT DISTINCT cname FROM results WHERE ingest_id = %s))""",
+            (ingest_id, ))
+        logger.info("Indexed {} flags and {} spectrum filenames from ingest {}"\
+            .format(N_flags, N_spectra, ingest_id))
+        return (N_flags, N_spectra)
+
+
+    def _copy_node_results(self, data, columns, wg, node_name, uves_node_id,
+        giraffe_node_id, ingest_id=None):
+        """
+        Load adapted node results into the `results` table in bulk. Nothing is
+        committed.
+
+        :param data:
+            The node results, after the format adapters have been applied.
+
+        :param columns:
+            The names of the `results` columns to load, starting with `node_id`.
+
+        :param wg:
+            The working group (e.g., 10).
+
+        :param node_name:
+            The name of the node (without the UVES- or GIRAFFE- prefix).
+
+        :param uves_node_id:
+            The node identifier to use for UVES results.
+
+        :param giraffe_node_id:
+            The node identifier to use for GIRAFFE results.
+
+        :param ingest_id: [optional]
+            The ingest manifest identifier to store with each row.
+
+        :returns:
+            The number of rows inserted.
+        """
+
+        t_init = time()
+
+        setups = np.char.strip(np.array(data["SETUP"], dtype=str))
+        node_ids = -np.ones(len(data), dtype=int)
+        node_ids[setups == "UVES"] = uves_node_id
+        node_ids[setups == "GIRAFFE"] = giraffe_node_id
+
+        if np.any(node_ids < 0):
+            raise ValueError("unrecognised setup(s) in results from {}: {}"\
+                .format(node_name, ", ".join(set(setups[node_ids < 0]))))
+
+        use_columns = ["node_id", "ingest_id"]
+        arrays = [node_ids, np.repeat(ingest_id, len(data)).astype(object)]
+        for column in columns[1:]:
+            values = data[column.upper()]
+
+            if node_name.lower() == "carmela-elena" \
+            and values.dtype.kind == "b":
+                continue
+
+            use_columns.append(column)
+            arrays.append(_strip_strings(values))
+
+        N = self.copy_from("results", use_columns, arrays)
+
+        taken = time() - t_init
+        logger.info("Ingested {} rows from node WG{}: {} in {:.1f} s "\
+            "({:.0f} rows/s)".format(N, wg, node_name, taken,
+                N / max(taken, 1e-6)))
         return N
 
 
-    def ingest_spectra_masterlist(self, filename, extension=-1):
+    def ingest_spectra_masterlist(self, filename, extension=-1, force=False,
+        blocksize=10000):
         """
-        Ingest a master list of spectra from a FITS template file.
+        Ingest a master list of spectra from a FITS template file. The file is
+        read (and loaded into the database) in blocks of rows, so the memory
+        used does not depend on the size of the masterlist.
 
         :param filename:
             A FITS template file that contains the masterlist of all spectra.
 
+        :param extension: [optional]
+            The HDU extension that contains the masterlist.
+
+        :param force: [optional]
+            Re-ingest the file even if the ingest manifest shows that it has
+            not changed since it was last ingested.
+
+        :param blocksize: [optional]
+            The number of rows to read and insert at a time.
+
         :returns:
             The number of rows inserted.
         """
 
-        image = fits.open(filename)
-        data = image[extension].data
+        ingest_id = self._begin_ingest(filename, "spectra", force)
+        if ingest_id is None:
+            return 0
 
         # Create mapper between FITS and database columns.
         columns = ("cname", "ges_fld", "object", "filename", "ges_type", "setup",
@@ -364,40 +885,40 @@ class GESDatabase(Database):
             "e_vrot", "teff_irfm", "e_teff_irfm", "peculi", "remark", "tech")
         fits_column_adapters = {
         }
+        as_float = partial(np.asarray, dtype=float)
         fits_format_adapters = {
-            "wg": utils.safe_int,
-            "ra": float,
-            "dec": float,
-            "snr": float,
-            "vel": float,
-            "e_vel": float,
-            "vrot": float,
-            "e_vrot": float,
-            "teff_irfm": float,
-            "e_teff_irfm": float,
+            "wg": lambda a: np.array([utils.safe_int(v) for v in a], dtype=int),
+            "ra": as_float,
+            "dec": as_float,
+            "snr": as_float,
+            "vel": as_float,
+            "e_vel": as_float,
+            "vrot": as_float,
+            "e_vrot": as_float,
+            "teff_irfm": as_float,
+            "e_teff_irfm": as_float,
         }
 
-        N = len(data)
-        for i, row in enumerate(data):
-            logger.info("Inserting row {}/{}".format(i, N))
+        N = 0
+        fits_columns = [fits_column_adapters.get(col, col) for col in columns]
+        for block in utils.read_fits_blocks(filename, fits_columns, extension,
+            blocksize=blocksize):
 
-            values = []
-            for col in columns:
-                use_col = fits_column_adapters.get(col, col)
-                value = row[use_col]
+            arrays = []
+            for col, use_col in zip(columns, fits_columns):
+                values = block[use_col]
 
                 # Formatting.
                 if col in fits_format_adapters:
-                    f = fits_format_adapters[col]
-                    value = f(value)
-                values.append(value)
+                    values = fits_format_adapters[col](values)
+                arrays.append(_strip_strings(values))
 
-            self.execute(
-                "INSERT INTO spectra ({}) VALUES ({})".format(
-                    ", ".join(columns), ", ".join(["%s"] * len(columns))),
-                values)
+            arrays.append(np.repeat(ingest_id, len(arrays[0])))
+            N += self.copy_from("spectra", columns + ("ingest_id", ), arrays)
+            logger.info("Inserted {} rows from {}".format(N, filename))
 
-        self.connection.commit()
+        self._finish_ingest(ingest_id, N)
+        self.commit()
 
         return N
 
@@ -422,19 +943,15 @@ class GESDatabase(Database):
         # ('CNAME_2', 'GES_FLD', 'teffjk', 'jk', 'FILENAME')
         cname_col, teff_col = (data.dtype.names[0], "teffjk")
 
-        # Update the value in the spectra table, unless it already exists.
-        N = 0
-        for row in data:
-            result = self.execute(
-                """ UPDATE spectra
-                    SET teff_irfm = %s
-                    WHERE   cname = %s AND
-                            teff_irfm = 'NaN'""",
-                        (float(row[teff_col]), row[cname_col], ))
+        # Update the value in the spectra table, unless it already exists. If a
+        # CNAME is given more than once, the first temperature is used.
+        self.patch_from_reference("spectra", "cname", ("teff_irfm", ),
+            (data[cname_col], np.array(data[teff_col], dtype=float)),
+            constraint="t.teff_irfm = 'NaN'", keep="first")
         return True
 
 
-    def ingest_recommended_results(self, filename, extension=1):
+    def ingest_recommended_results(self, filename, extension=1, force=False):
         """
         Ingest a FITS table containing Working Group-level recommended products.
 
@@ -443,15 +960,23 @@ class GESDatabase(Database):
 
         :param extension: [optional]
             The HDU extension that contains the WG-level recommended values.
+
+        :param force: [optional]
+            Re-ingest the file even if the ingest manifest shows that it has
+            not changed since it was last ingested.
         """
 
         # Which WG is this?
         wg = utils.parse_wg_from_file(filename)
 
+        ingest_id = self._begin_ingest(filename, "wg_recommended_results", force)
+        if ingest_id is None:
+            return
+
         # Start ingesting results.
         data = Table.read(filename, hdu=extension)
 
-        default_row = { "wg": wg }
+        default_row = { "wg": wg, "ingest_id": ingest_id }
         columns = ("wg", # For default row
             "cname", "filename", "setup", "snr",
             "vel", "e_vel", "vrot", "e_vrot",
@@ -510,15 +1035,15 @@ class GESDatabase(Database):
         )
 
         # Update formats, as necessary.
-        tmp_key_format = "{}_NEW_DTYPE"
-        for key, new_dtype in _FITS_FORMAT_ADAPTERS.items():
-            data[tmp_key_format.format(key.upper())] = np.array(data[key.upper()], dtype=new_dtype)
-            del data[key.upper()]
-            data.rename_column(tmp_key_format.format(key.upper()), key.upper())
+        _apply_format_adapters(data, _compile_format_adapters())
+
+        query = "INSERT INTO wg_recommended_results ({}, ingest_id) VALUES ({})"\
+            .format(", ".join(columns), ", ".join(["%({})s".format(column) \
+                for column in columns + ("ingest_id", )]))
 
         N = len(data)
+        statements = []
         for i, row in enumerate(data):
-            logger.info("Ingesting row {}/{} from WG{}".format(i, N, wg))
             row_data = {}
             row_data.update(default_row)
             row_data.update(dict(zip(columns[1:], [row[c.upper()] for c in columns[1:]])))
@@ -528,16 +1053,90 @@ class GESDatabase(Database):
                 if isinstance(row_data[k], str):
                     row_data[k] = row_data[k].strip()
 
-            self.execute(
-                "INSERT INTO wg_recommended_results ({}) VALUES ({})".format(
-                    ", ".join(columns),
-                    ", ".join(["%({})s".format(column) for column in columns])),
-                row_data)
+            statements.append((query, row_data))
+
+        # Send the rows in pages, instead of one round-trip per row.
+        logger.info("Ingesting {} rows from WG{}".format(N, wg))
+        self.execute_many_pipelined(statements)
 
-        self.connection.commit()
+        self._finish_ingest(ingest_id, N)
+        self.commit()
 
         return
 
 
+def _ingest_node_results_worker(args):
+    """
+    Ingest a single node file on a new database connection. This is used by
+    `ingest_node_results_in_parallel`, and must be a module-level function so
+    that it can be sent to worker processes.
+    """
+
+    credentials, filename, kwargs = args
+
+    t_init = time()
+    database = GESDatabase(**credentials)
+    try:
+        N = database.ingest_node_results(filename, **kwargs)
+
+    except:
+        logger.exception("Failed to ingest {}".format(filename))
+        database.rollback()
+        raise
+
+    finally:
+        database.connection.close()
+
+    return (filename, N, time() - t_init)
+
+
+def ingest_node_results_in_parallel(credentials, filenames, processes=None,
+    **kwargs):
+    """
+    Ingest many node files in parallel. Each worker process opens its own
+    database connection and ingests (and commits) one file at a time, so each
+    file is loaded in its own transaction.
+
+    Nodes must already exist in the database before this is called.
+
+    :param credentials:
+        A dictionary of keywords to connect to the database.
+
+    :param filenames:
+        The local paths of node template files in FITS format.
+
+    :param processes: [optional]
+        The number of worker processes to use. Defaults to the number of CPUs.
+
+    Other keyword arguments are passed to `GESDatabase.ingest_node_results`.
+
+    :returns:
+        A table summarising the number of rows and the time taken for each file.
+    """
+
+    t_init = time()
+
+    # Compile the format adapters once, instead of once for every file.
+    kwargs["compiled_adapters"] = _compile_node_format_adapters(
+        kwargs.pop("adapters", None))
+
+    pool = mp.Pool(processes=processes)
+    try:
+        summary = pool.map(_ingest_node_results_worker,
+            [(credentials, filename, kwargs) for filename in filenames],
+            chunksize=1)
+
+    finally:
+        pool.close()
+        pool.join()
+
+    logger.info("Ingested {} rows from {} files in {:.1f} s".format(
+        sum([N for _, N, __ in summary]), len(summary), time() - t_init))
+
+    if not summary:
+        return None
+    return Table(rows=summary, names=("Filename", "N", "Seconds"))
+
+
 class UnknownNodeError(BaseException):
     pass
@@ -0,0 +1,27 @@
+/*
+    Indexes for the columns that the pipeline filters and joins on.
+*/
+
+CREATE INDEX IF NOT EXISTS results_cname ON results (cname);
+CREATE INDEX IF NOT EXISTS results_filename ON results (filename);
+CREATE INDEX IF NOT EXISTS results_node_id_cname ON results (node_id, cname);
+CREATE INDEX IF NOT EXISTS results_passed_qc_cname ON results (cname)
+    WHERE passed_quality_control;
+CREATE INDEX IF NOT EXISTS results_passed_qc_node_id_cname
+    ON results (node_id, cname) WHERE passed_quality_control;
+CREATE INDEX IF NOT EXISTS results_failed_qc ON results (id)
+    WHERE NOT passed_quality_control;
+
+CREATE INDEX IF NOT EXISTS spectra_cname ON spectra (cname);
+CREATE INDEX IF NOT EXISTS spectra_filename ON spectra (filename);
+CREATE INDEX IF NOT EXISTS spectra_ges_fld ON spectra (ges_fld);
+
+CREATE INDEX IF NOT EXISTS wg_recommended_results_cname
+    ON wg_recommended_results (cname);
+
+CREATE INDEX IF NOT EXISTS nodes_wg ON nodes (wg);
+
+ANALYZE results;
+ANALYZE spectra;
+ANALYZE wg_recommended_results;
+ANALYZE nodes;
@@ -0,0 +1,49 @@
+/*
+    A normalised table of the TECH, PECULI and REMARK flags given for each
+    result, so that flags can be matched with indexed equality joins instead of
+    pattern matching the pipe-delimited strings in the results table.
+
+    Flags look like 10106-11-00-00-A: the issue code, the working group, the
+    node code, and then a suffix. Some nodes only give the issue code.
+*/
+
+CREATE TABLE IF NOT EXISTS result_flags (
+    result_id bigint not null references results (id) on delete cascade,
+    kind text not null,
+    issue_code text not null,
+    wg text,
+    node_code text,
+    suffix text,
+    raw text not null
+);
+ALTER TABLE result_flags ADD COLUMN id BIGSERIAL PRIMARY KEY;
+CREATE INDEX result_flags_issue_code ON result_flags (issue_code);
+CREATE INDEX result_flags_kind_issue_code ON result_flags (kind, issue_code);
+CREATE INDEX result_flags_result_id ON result_flags (result_id);
+
+/* Parse the flags for results from one ingested file (or all, if null). */
+CREATE OR REPLACE FUNCTION index_result_flags(ingest integer) RETURNS bigint AS $$
+    WITH inserted AS (
+        INSERT INTO result_flags (
+            result_id, kind, issue_code, wg, node_code, suffix, raw)
+        SELECT  r.id, k.kind,
+                split_part(f.raw, '-', 1),
+                NULLIF(split_part(f.raw, '-', 2), ''),
+                NULLIF(split_part(f.raw, '-', 3), ''),
+                NULLIF(substring(f.raw from '^(?:[^-]*-){3}(.*)$'), ''),
+                f.raw
+          FROM  results AS r,
+                LATERAL (VALUES ('tech', r.tech),
+                                ('peculi', r.peculi),
+                                ('remark', r.remark)) AS k (kind, flags),
+                LATERAL (SELECT trim(flag)
+                           FROM regexp_split_to_table(k.flags, '\|') AS flag)
+                        AS f (raw)
+         WHERE  (ingest IS NULL OR r.ingest_id = ingest)
+           AND  f.raw NOT IN ('', 'NaN')
+        RETURNING 1)
+    SELECT count(*) FROM inserted
+$$ LANGUAGE SQL;
+
+SELECT index_result_flags(NULL);
+ANALYZE result_flags;
@@ -0,0 +1,55 @@
+/*
+    Store strings as text instead of fixed-width char(n) columns, so that values
+    are not blank-padded and can be compared (and looked up by index) without
+    wrapping the column in TRIM(). Existing values are trimmed.
+*/
+
+ALTER TABLE spectra
+    ALTER COLUMN cname TYPE text USING trim(cname),
+    ALTER COLUMN ges_fld TYPE text USING trim(ges_fld),
+    ALTER COLUMN object TYPE text USING trim(object),
+    ALTER COLUMN filename TYPE text USING trim(filename),
+    ALTER COLUMN ges_type TYPE text USING trim(ges_type),
+    ALTER COLUMN setup TYPE text USING trim(setup),
+    ALTER COLUMN peculi TYPE text USING trim(peculi),
+    ALTER COLUMN remark TYPE text USING trim(remark),
+    ALTER COLUMN tech TYPE text USING trim(tech);
+
+ALTER TABLE recommended_idr4
+    ALTER COLUMN cname TYPE text USING trim(cname),
+    ALTER COLUMN ges_fld TYPE text USING trim(ges_fld),
+    ALTER COLUMN object TYPE text USING trim(object),
+    ALTER COLUMN filename TYPE text USING trim(filename),
+    ALTER COLUMN ges_type TYPE text USING trim(ges_type),
+    ALTER COLUMN peculi TYPE text USING trim(peculi),
+    ALTER COLUMN remark TYPE text USING trim(remark),
+    ALTER COLUMN tech TYPE text USING trim(tech);
+
+ALTER TABLE nodes
+    ALTER COLUMN name TYPE text USING trim(name);
+
+ALTER TABLE results
+    ALTER COLUMN cname TYPE text USING trim(cname),
+    ALTER COLUMN filename TYPE text USING trim(filename),
+    ALTER COLUMN setup TYPE text USING trim(setup),
+    ALTER COLUMN peculi TYPE text USING trim(peculi),
+    ALTER COLUMN remark TYPE text USING trim(remark),
+    ALTER COLUMN tech TYPE text USING trim(tech),
+    ALTER COLUMN propagated_peculi TYPE text USING trim(propagated_peculi),
+    ALTER COLUMN propagated_remark TYPE text USING trim(propagated_remark),
+    ALTER COLUMN propagated_tech TYPE text USING trim(propagated_tech);
+
+ALTER TABLE wg_recommended_results
+    ALTER COLUMN cname TYPE text USING trim(cname),
+    ALTER COLUMN peculi TYPE text USING trim(peculi),
+    ALTER COLUMN remark TYPE text USING trim(remark),
+    ALTER COLUMN tech TYPE text USING trim(tech),
+    ALTER COLUMN spt TYPE text USING trim(spt),
+    ALTER COLUMN m_grid TYPE text USING trim(m_grid),
+    ALTER COLUMN m_name TYPE text USING trim(m_name);
+
+ANALYZE spectra;
+ANALYZE recommended_idr4;
+ANALYZE nodes;
+ANALYZE results;
+ANALYZE wg_recommended_results;
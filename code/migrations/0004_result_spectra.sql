@@ -0,0 +1,30 @@
+/*
+    A link table between results and each of the spectrum filenames they were
+    derived from (results.filename can hold several, joined by |), so that
+    results can be matched by spectrum with indexed joins instead of substring
+    scans.
+*/
+
+CREATE TABLE IF NOT EXISTS result_spectra (
+    result_id bigint not null references results (id) on delete cascade,
+    spectrum_filename text not null
+);
+CREATE INDEX result_spectra_result_id ON result_spectra (result_id);
+CREATE INDEX result_spectra_spectrum_filename
+    ON result_spectra (spectrum_filename);
+
+/* Split the filenames for results from one ingested file (or all, if null). */
+CREATE OR REPLACE FUNCTION index_result_spectra(ingest integer) RETURNS bigint AS $$
+    WITH inserted AS (
+        INSERT INTO result_spectra (result_id, spectrum_filename)
+        SELECT  DISTINCT r.id, trim(f.filename)
+          FROM  results AS r,
+                regexp_split_to_table(r.filename, '\|') AS f (filename)
+         WHERE  (ingest IS NULL OR r.ingest_id = ingest)
+           AND  trim(f.filename) <> ''
+        RETURNING 1)
+    SELECT count(*) FROM inserted
+$$ LANGUAGE SQL;
+
+SELECT index_result_spectra(NULL);
+ANALYZE result_spectra;
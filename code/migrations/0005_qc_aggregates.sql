@@ -0,0 +1,69 @@
+/*
+    Per-spectrum and per-CNAME aggregates of the node results that pass quality
+    control, used to find spectra whose parameters are discrepant from the
+    other spectra of the same star.
+
+    Each spectrum (filename) has the mean teff and feh over the nodes that
+    analysed it, and each star has the mean and standard deviation of those
+    per-spectrum means.
+*/
+
+CREATE TABLE IF NOT EXISTS spectrum_aggregates (
+    wg integer not null,
+    cname text not null,
+    filename text not null,
+    result_id bigint not null,
+    n_nodes integer not null,
+    avg_teff numeric,
+    avg_feh numeric
+);
+CREATE UNIQUE INDEX spectrum_aggregates_wg_filename
+    ON spectrum_aggregates (wg, filename);
+CREATE INDEX spectrum_aggregates_cname ON spectrum_aggregates (cname);
+
+CREATE TABLE IF NOT EXISTS cname_aggregates (
+    wg integer not null,
+    cname text not null,
+    n_spectra integer not null,
+    avg_teff numeric,
+    stddev_teff numeric,
+    avg_feh numeric,
+    stddev_feh numeric
+);
+CREATE UNIQUE INDEX cname_aggregates_wg_cname ON cname_aggregates (wg, cname);
+
+/* Recompute the aggregates for some stars (or all, if null). */
+CREATE OR REPLACE FUNCTION refresh_qc_aggregates(cnames text[]) RETURNS void AS $$
+    DELETE FROM spectrum_aggregates
+     WHERE cnames IS NULL OR cname = ANY(cnames);
+
+    DELETE FROM cname_aggregates
+     WHERE cnames IS NULL OR cname = ANY(cnames);
+
+    INSERT INTO spectrum_aggregates (
+        wg, cname, filename, result_id, n_nodes, avg_teff, avg_feh)
+    SELECT  t.wg, min(t.cname), t.filename, min(t.id), count(*),
+            avg(t.teff) FILTER (WHERE t.teff <> 'NaN'),
+            avg(t.feh) FILTER (WHERE t.feh <> 'NaN')
+      FROM  (SELECT  DISTINCT ON (r.filename, r.node_id)
+                     r.id, n.wg, r.cname, r.filename, r.teff, r.feh
+               FROM  results AS r, nodes AS n
+              WHERE  r.node_id = n.id
+                AND  r.passed_quality_control
+                AND  (r.teff <> 'NaN' OR r.feh <> 'NaN')
+                AND  (cnames IS NULL OR r.cname = ANY(cnames))
+              ORDER BY r.filename, r.node_id, r.id) AS t
+     GROUP BY t.wg, t.filename;
+
+    INSERT INTO cname_aggregates (
+        wg, cname, n_spectra, avg_teff, stddev_teff, avg_feh, stddev_feh)
+    SELECT  wg, cname, count(*),
+            avg(avg_teff), stddev(avg_teff), avg(avg_feh), stddev(avg_feh)
+      FROM  spectrum_aggregates
+     WHERE  cnames IS NULL OR cname = ANY(cnames)
+     GROUP BY wg, cname;
+$$ LANGUAGE SQL;
+
+SELECT refresh_qc_aggregates(NULL);
+ANALYZE spectrum_aggregates;
+ANALYZE cname_aggregates;
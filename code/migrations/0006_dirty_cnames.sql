@@ -0,0 +1,27 @@
+/*
+    A work queue of stars (CNAMEs) whose node results have changed since
+    quality control was last run on them. Ingests add stars to the queue, and
+    scripts/propagate_flags.py removes them once they have been re-evaluated.
+*/
+
+CREATE TABLE IF NOT EXISTS dirty_cnames (
+    cname text primary key,
+    marked timestamp not null default clock_timestamp()
+);
+CREATE INDEX dirty_cnames_marked ON dirty_cnames (marked);
+
+/*
+    Add stars to the queue, or update when they were last marked. Rows are
+    locked in CNAME order, so that concurrent ingests do not deadlock. The
+    wall-clock time is used (not the transaction start time) so that a star
+    marked again always gets a new `marked` value.
+*/
+CREATE OR REPLACE FUNCTION mark_dirty_cnames(cnames text[]) RETURNS bigint AS $$
+    WITH m AS (
+        INSERT INTO dirty_cnames (cname)
+        SELECT  DISTINCT unnest(cnames)
+         ORDER  BY 1
+            ON  CONFLICT (cname) DO UPDATE SET marked = clock_timestamp()
+     RETURNING  1)
+    SELECT count(*) FROM m;
+$$ LANGUAGE SQL;
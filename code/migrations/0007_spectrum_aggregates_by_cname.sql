@@ -0,0 +1,45 @@
+/*
+    Key the per-spectrum aggregates by star as well as by spectrum. A spectrum
+    (filename) can have results for more than one star, and refreshing the
+    aggregates for some stars must not change the rows of any other star.
+*/
+
+DROP INDEX IF EXISTS spectrum_aggregates_wg_filename;
+CREATE UNIQUE INDEX spectrum_aggregates_wg_cname_filename
+    ON spectrum_aggregates (wg, cname, filename);
+
+/* Recompute the aggregates for some stars (or all, if null). */
+CREATE OR REPLACE FUNCTION refresh_qc_aggregates(cnames text[]) RETURNS void AS $$
+    DELETE FROM spectrum_aggregates
+     WHERE cnames IS NULL OR cname = ANY(cnames);
+
+    DELETE FROM cname_aggregates
+     WHERE cnames IS NULL OR cname = ANY(cnames);
+
+    INSERT INTO spectrum_aggregates (
+        wg, cname, filename, result_id, n_nodes, avg_teff, avg_feh)
+    SELECT  t.wg, t.cname, t.filename, min(t.id), count(*),
+            avg(t.teff) FILTER (WHERE t.teff <> 'NaN'),
+            avg(t.feh) FILTER (WHERE t.feh <> 'NaN')
+      FROM  (SELECT  DISTINCT ON (r.cname, r.filename, r.node_id)
+                     r.id, n.wg, r.cname, r.filename, r.teff, r.feh
+               FROM  results AS r, nodes AS n
+              WHERE  r.node_id = n.id
+                AND  r.passed_quality_control
+                AND  (r.teff <> 'NaN' OR r.feh <> 'NaN')
+                AND  (cnames IS NULL OR r.cname = ANY(cnames))
+              ORDER BY r.cname, r.filename, r.node_id, r.id) AS t
+     GROUP BY t.wg, t.cname, t.filename;
+
+    INSERT INTO cname_aggregates (
+        wg, cname, n_spectra, avg_teff, stddev_teff, avg_feh, stddev_feh)
+    SELECT  wg, cname, count(*),
+            avg(avg_teff), stddev(avg_teff), avg(avg_feh), stddev(avg_feh)
+      FROM  spectrum_aggregates
+     WHERE  cnames IS NULL OR cname = ANY(cnames)
+     GROUP BY wg, cname;
+$$ LANGUAGE SQL;
+
+SELECT refresh_qc_aggregates(NULL);
+ANALYZE spectrum_aggregates;
+ANALYZE cname_aggregates;
@@ -14,6 +14,7 @@ from itertools import combinations
 from time import time
 
 from . import plot
+from ..db import UpsertBuffer
 
 logger = logging.getLogger("ges")
 
@@ -42,8 +43,28 @@ def _guess_parameter_names(table, names):
 
 
 
+def _recommended_results_buffer(database, upsert_batch_size=1000,
+    upsert_interval=None, **kwargs):
+    """
+    Return a write-behind buffer for rows in the `wg_recommended_results` table.
+
+    :param database:
+        The database to write to.
+
+    :param upsert_batch_size: [optional]
+        The number of rows to buffer before they are written.
+
+    :param upsert_interval: [optional]
+        The maximum number of seconds between writes.
+    """
+    return UpsertBuffer(database, "wg_recommended_results", ("wg", "cname"),
+        batch_size=upsert_batch_size, interval=upsert_interval)
+
+
+
 def _homogenise_survey_measurements(database, wg, parameter, cname, N=100,
-    stan_model=None, update_database=True, sql_constraint=None, **kwargs):
+    stan_model=None, update_database=True, sql_constraint=None,
+    upsert_buffer=None, **kwargs):
     """
     Produce an unbiased estimate of an astrophyiscal parameter for a given
     survey object.
@@ -66,26 +87,32 @@ def _homogenise_survey_measurements(database, wg, parameter, cname, N=100,
 
         Either the fitted stan model must be provided, or the Stan chains and 
         the data dictionary (`stan_chains` and `stan_data`) must be provided.
+
+    :param upsert_buffer: [optional]
+        A buffer for rows in the `wg_recommended_results` table. If given, the
+        result is added to the buffer and the caller is responsible for writing
+        it to the database. Otherwise the result is written immediately.
     """
 
-    sql_constraint = \
-        "" if sql_constraint is None else " AND {}".format(sql_constraint)
+    # The constraint is escaped because the query is formatted by psycopg2.
+    sql_constraint = "" if sql_constraint is None \
+        else " AND {}".format(sql_constraint.replace("%", "%%"))
 
     # Get the data for this object.
     estimates = database.retrieve_table(
         """ SELECT  DISTINCT ON (filename, node_id)
-                    results.id, cname, node_id, snr, setup, trim(filename) as filename, 
+                    results.id, cname, node_id, snr, setup, filename, 
                     teff, logg, feh,
                     passed_quality_control
             FROM    results, nodes
-            WHERE   nodes.wg = {wg}
+            WHERE   nodes.wg = %s
               AND   nodes.id = results.node_id
-              AND   cname = '{cname}'
+              AND   cname = %s
               AND   {parameter} <> 'NaN'
               AND   passed_quality_control = true
               {sql_constraint};
-        """.format(wg=wg, cname=cname, parameter=parameter, 
-                sql_constraint=sql_constraint))
+        """.format(parameter=parameter, sql_constraint=sql_constraint),
+        (wg, cname), prepare=True)
 
     if estimates is None:
         return np.nan * np.ones(4)
@@ -238,35 +265,13 @@ def _homogenise_survey_measurements(database, wg, parameter, cname, N=100,
             "sys_err_{}".format(parameter): sys_error
         }
 
-        record = database.retrieve(
-            """ SELECT id
-                  FROM wg_recommended_results
-                 WHERE wg = %s
-                   AND cname = %s
-            """, (wg, cname, ))
-
-        if record:
-            database.update(
-                """ UPDATE wg_recommended_results
-                       SET {}
-                     WHERE id = '{}'""".format(
-                        ", ".join([" = ".join([k, "%s"]) for k in data.keys()]),
-                        record[0][0]),
-                data.values())
-            logger.info(
-                "Updated record {} in wg_recommended_results".format(record[0][0]))
-
-            print(wg, cname, parameter, mu, pos_uncertainty, neg_uncertainty, sys_error)
+        if upsert_buffer is None:
+            buffer = _recommended_results_buffer(database)
+            buffer.add(data)
+            buffer.flush()
 
         else:
-            new_record = database.retrieve(
-                """ INSERT INTO wg_recommended_results ({})
-                    VALUES ({}) RETURNING id""".format(
-                        ", ".join(data.keys()), ", ".join(["%s"] * len(data))),
-                data.values())
-            logger.info(
-                "Created new record {} in wg_recommended_results ({} / {})"\
-                .format(new_record[0][0], wg, cname))
+            upsert_buffer.add(data)
 
     return (mu, pos_uncertainty, neg_uncertainty, sys_error)
 
@@ -292,7 +297,7 @@ class MedianModel(object):
 
 
     def _homogenise_survey_measurement(self, cname, update_database=False,
-        **kwargs):
+        upsert_buffer=None, **kwargs):
 
         param = self._parameter
 
@@ -301,10 +306,10 @@ class MedianModel(object):
             """ SELECT results.id, node_id, filename, {parameter}, e_{parameter}
                   FROM results, nodes
                  WHERE results.node_id = nodes.id
-                   AND nodes.wg = '{wg}'
-                   AND results.cname = '{cname}'
+                   AND nodes.wg = %s
+                   AND results.cname = %s
                    AND results.passed_quality_control;""".format(
-                    parameter=param, wg=self._wg, cname=cname))
+                    parameter=param), (self._wg, cname), prepare=True)
 
         if records is None:
             return {}
@@ -333,34 +338,13 @@ class MedianModel(object):
             .format(param, self._wg, cname, mu, sigma, S, N))
 
         if update_database:
-
-            record = self._database.retrieve(
-                """ SELECT id
-                      FROM wg_recommended_results
-                     WHERE wg = %s
-                       AND cname = %s
-                """, (self._wg, cname, ))
-
-            if record:
-                self._database.update(
-                    """ UPDATE wg_recommended_results
-                           SET {}
-                         WHERE id = '{}'""".format(
-                            ", ".join([" = ".join([k, "%s"]) for k in result.keys()]),
-                            record[0][0]),
-                    result.values())
-                logger.info(
-                    "Updated record {} in wg_recommended_results".format(record[0][0]))
+            if upsert_buffer is None:
+                buffer = _recommended_results_buffer(self._database)
+                buffer.add(result)
+                buffer.flush()
 
             else:
-                new_record = self._database.retrieve(
-                    """ INSERT INTO wg_recommended_results ({})
-                        VALUES ({}) RETURNING id""".format(
-                            ", ".join(result.keys()), ", ".join(["%s"] * len(result))),
-                    result.values())
-                logger.info(
-                    "Created new record {} in wg_recommended_results ({} / {})"\
-                    .format(new_record[0][0], self._wg, cname))
+                upsert_buffer.add(result)
 
         return result
 
@@ -385,14 +369,17 @@ class MedianModel(object):
 
         # Get samples and data dictionary -- it will be faster.
         
+        buffer = _recommended_results_buffer(self._database, **kwargs)
+
         N = len(records)
         for i, cname in enumerate(records["cname"]):
 
             self._homogenise_survey_measurement(
-                cname, update_database=update_database, **kwargs)
+                cname, update_database=update_database, upsert_buffer=buffer,
+                **kwargs)
 
         if update_database:
-            self._database.connection.commit()
+            buffer.commit()
 
         return None
 
@@ -615,15 +602,18 @@ class BaseEnsembleModel(object):
             ORDER BY cname DESC""".format(self._wg))
         assert records is not None
 
+        buffer = _recommended_results_buffer(self._database, **kwargs)
+
         N = len(records)
         for i, cname in enumerate(records["cname"]):
 
             _homogenise_survey_measurements(self._database, self._wg,
                 self._parameter, cname, stan_model=self, 
-                update_database=update_database, **kwargs)
+                update_database=update_database, upsert_buffer=buffer,
+                **kwargs)
 
         if update_database:
-            self._database.connection.commit()
+            buffer.commit()
 
         return None
     
@@ -646,12 +636,14 @@ class BaseEnsembleModel(object):
 
         assert self._data is not None
 
+        buffer = _recommended_results_buffer(self._database, **kwargs)
+
         N = len(records)
         for i, cname in enumerate(records["cname"]):
 
             mu, e_pos, e_neg, e_stat = _homogenise_survey_measurements(
                 self._database, self._wg, self._parameter, cname,
-                stan_model=self, **kwargs)
+                stan_model=self, upsert_buffer=buffer, **kwargs)
             
             logger.info("Homogenised {parameter} for {cname} (WG{wg} {i}/{N}): "
                 "{mu:.2f} ({pos_error:.2f}, {neg_error:.2f}, {stat_error:.2f})"\
@@ -661,7 +653,7 @@ class BaseEnsembleModel(object):
                     pos_error=e_pos, neg_error=e_neg, stat_error=e_stat))
 
         if kwargs.get("update_database", True):
-            self._database.connection.commit()
+            buffer.commit()
 
         return None
 
@@ -691,12 +683,14 @@ class BaseEnsembleModel(object):
 
         autocommit = kwargs.get("autocommit", False)
 
+        buffer = _recommended_results_buffer(self._database, **kwargs)
+
         N = len(records)
         for i, cname in enumerate(records["cname"]):
 
             mu, e_pos, e_neg, e_stat = _homogenise_survey_measurements(
                 self._database, self._wg, self._parameter, cname,
-                stan_model=self, **kwargs)
+                stan_model=self, upsert_buffer=buffer, **kwargs)
             
             logger.info("Homogenised {parameter} for {cname} (WG{wg} {i}/{N}): "
                 "{mu:.2f} ({pos_error:.2f}, {neg_error:.2f}, {stat_error:.2f})"\
@@ -706,10 +700,10 @@ class BaseEnsembleModel(object):
                     pos_error=e_pos, neg_error=e_neg, stat_error=e_stat))
 
             if autocommit:
-                self._database.connection.commit()
+                buffer.commit()
 
         if kwargs.get("update_database", True):
-            self._database.connection.commit()
+            buffer.commit()
 
         return None
 
@@ -863,7 +857,8 @@ class EnsembleModel(BaseEnsembleModel):
                 """.format(
                     wg=self._wg, parameter=parameter,
                     sql_constraint=""   if sql_constraint is None \
-                                        else " AND {}".format(sql_constraint)))
+                                        else " AND {}".format(sql_constraint)),
+            fast=True)
         assert data is not None, "No calibrator data from WG {}".format(wg)
 
         # Calibrator parameter names
@@ -1010,13 +1005,12 @@ class EnsembleModel(BaseEnsembleModel):
             dict(zip(("lower_bound", "upper_bound"), bounds[parameter])))
 
         # Create additional metadata
-        node_names = self._database.retrieve_table("SELECT * FROM nodes")
+        node_names = self._database.node_registry[0]
         metadata = {
             "calibrators": calibrators,
             "node_ids": unique_estimators,
             "node_names": \
-                [node_names["name"][node_names["id"] == node_id][0].strip() \
-                    for node_id in unique_estimators]
+                [node_names[int(node_id)][1] for node_id in unique_estimators]
         }
         result = (data_dict, metadata)
         self._data, self._metadata = result
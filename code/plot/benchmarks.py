@@ -76,7 +76,7 @@ def node_benchmark_performance(database, wg, node_name, sort_by="TEFF",
                     FROM    results r, spectra s
                     WHERE   r.cname = s.cname
                     AND     r.node_id = %s
-                    AND     TRIM(s.ges_fld) = %s""".format(parameter),
+                    AND     s.ges_fld = %s""".format(parameter),
                 (node_id, benchmark["GES_FLD"].strip()))
 
             if results is None:
@@ -247,7 +247,7 @@ def wg_benchmark_performance(database, wg, truths, show_recommended=False,
                      WHERE  nodes.wg = '{wg}'
                        AND  results.node_id = nodes.id
                        AND  results.cname = spectra.cname
-                       AND  TRIM(spectra.ges_fld) = '{ges_fld}'
+                       AND  spectra.ges_fld = '{ges_fld}'
                        AND  {parameter} <> 'NaN'
                        {node_sql_constraint_str};""".format(**kwds))
 
@@ -270,7 +270,7 @@ def wg_benchmark_performance(database, wg, truths, show_recommended=False,
                           FROM  {recommended_table} as wgr, spectra
                          WHERE  wgr.wg = {wg}
                            AND  wgr.cname = spectra.cname
-                           AND  TRIM(spectra.ges_fld) = '{ges_fld}';
+                           AND  spectra.ges_fld = '{ges_fld}';
                     """.format(**kwds))
 
                 if wg_recommended is None:
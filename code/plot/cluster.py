@@ -64,7 +64,7 @@ def param_vs_param(database, wg, node_name, ges_fld, reference_parameter,
                     teff, e_teff, logg, e_logg, feh, e_feh, mh, e_mh, xi, e_xi
             FROM    results r, spectra s 
             WHERE   r.cname = s.cname
-                AND TRIM(s.ges_fld) = %s
+                AND s.ges_fld = %s
                 AND s.vel > %s
                 AND s.vel < %s
                 AND node_id = %s""",
@@ -159,7 +159,7 @@ def cluster(database, ges_fld, wg, node_name=None, vel_range=None,
 
     
     if no_tech_flags:
-        tech_flag_constraint = " AND TRIM(r.TECH) = ''"
+        tech_flag_constraint = " AND r.tech = ''"
 
     else:
         tech_flag_constraint = ""
@@ -171,7 +171,7 @@ def cluster(database, ges_fld, wg, node_name=None, vel_range=None,
                     r.teff, r.e_teff, r.logg, r.e_logg, r.feh, r.e_feh, r.mh, r.e_mh
             FROM    {table} r, spectra s 
             WHERE   r.cname = s.cname
-                AND TRIM(s.ges_fld) = '{ges_fld}'
+                AND s.ges_fld = '{ges_fld}'
                 AND s.vel > '{lower_vel}'
                 AND s.vel < '{upper_vel}'
                 {sql_constraint} {tech_flag_constraint}""".format(
@@ -25,7 +25,7 @@ with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "harris.yaml
 def get_valid_clusters(database):
 
     t = database.retrieve_table(
-        """ SELECT  DISTINCT ON (s.ges_fld) TRIM(s.ges_fld) AS ges_fld
+        """ SELECT  DISTINCT ON (s.ges_fld) s.ges_fld
               FROM  wg_recommended_results AS r,
                     spectra as s
              WHERE  s.cname = r.cname
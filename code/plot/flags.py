@@ -2,11 +2,12 @@
 
 import numpy as np
 import matplotlib.pyplot as plt
-from itertools import combinations
 from matplotlib.colors import LogNorm
 
 import scipy.sparse.csgraph
 
+from ..flagindex import FlagIndex
+
 
 _WG14_NODE_IDS = {
     "01": "Arcetri",
@@ -74,9 +75,6 @@ def heatmap(database, wg, kind="tech", show_multiple_flags_per_node=True,
         The size of the figure in inches `(xsize, ysize)`.
     """
 
-    # Ensure to strip on | because some nodes give trailing | entries.
-    _strip_chars = " |"
-
     kind = kind.lower()
     kind_available = ("tech", "remark", "peculi")
     if kind not in kind_available:
@@ -90,72 +88,51 @@ def heatmap(database, wg, kind="tech", show_multiple_flags_per_node=True,
             raise ValueError("ordering by '{}' not available: {}".format(
                 group_by, ", ".join(group_by_available)))
 
-    # Select everything with a non-zero flag entry
-    results = database.retrieve_table(
-        """ WITH n as (
-                SELECT id FROM nodes WHERE wg = {wg})
-            SELECT r.node_id, r.cname, r.{kind}
-            FROM n, results as r
-            WHERE TRIM(r.{kind}) <> ''
-              AND TRIM(r.{kind}) <> 'NaN'
-              AND r.node_id = n.id
-        """.format(wg=wg, kind=kind)) 
-
-    flat_flags \
-        = sum([_.strip(_strip_chars).split("|") for _ in results[kind]], [])
+    # Select the unique (issue, node) flags given for each star.
+    flags = database.retrieve_table(
+        """ SELECT DISTINCT r.cname, f.issue_code, f.node_code
+              FROM nodes AS n, results AS r, result_flags AS f
+             WHERE n.wg = %s
+               AND r.node_id = n.id
+               AND f.result_id = r.id
+               AND f.kind = %s
+               AND f.node_code IS NOT NULL
+          ORDER BY r.cname""", (wg, kind))
 
     # Unique issue id numbers.
-    issue_ids = np.sort(np.unique([each.split("-")[0] for each in flat_flags]))
+    issue_ids = np.unique(flags["issue_code"])
 
     # Node ids.
-    node_ids = np.sort(np.unique([each.split("-")[2] for each in flat_flags]))
+    node_ids = np.unique(flags["node_code"])
 
     L, M = len(issue_ids), len(node_ids)
     Z = np.zeros((L * M, L * M), dtype=int)
 
+    issue_indices = np.searchsorted(issue_ids, flags["issue_code"])
+    node_indices = np.searchsorted(node_ids, flags["node_code"])
+
     if group_by == "node" or group_by is None:
-        get_index = lambda issue, node: \
-            (np.where(node_ids == node)[0][0] * len(issue_ids) \
-                + np.where(issue_ids == issue)[0][0])
+        grid_indices = node_indices * L + issue_indices
+        get_node_index = lambda grid_index: grid_index // L
         labels = np.tile(issue_ids, M)
 
     elif group_by == "issue":
-        get_index = lambda issue, node: \
-            (np.where(issue_ids == issue)[0][0] * len(node_ids)) \
-                + np.where(node_ids == node)[0][0]
+        grid_indices = issue_indices * M + node_indices
+        get_node_index = lambda grid_index: grid_index % M
         labels = np.repeat(issue_ids, M)
 
     else:
         raise ValueError("sorting by '{}' not available".format(group_by))
 
-    # Group results by CNAME.
-    for group in results.group_by("cname").groups:
-
-        if isinstance(group[kind], (str, unicode)):
-            group_flags = group[kind].strip(_strip_chars).split("|")
-        else:
-            group_flags \
-                = sum([_.strip(_strip_chars).split("|") for _ in group[kind]], [])
-
-        if len(group_flags) == 1:
-            continue
-
-        # Remove the WG and confidence entry.
-        flags = np.unique(
-            ["-".join([_.split("-")[0], _.split("-")[2]]) for _ in group_flags])
-
-        for x, y in combinations(flags, 2):
-
-            x_issue, x_node = x.split("-")
-            y_issue, y_node = y.split("-")
-
-            if x_node == y_node and not show_multiple_flags_per_node: continue
-
-            xi = get_index(x_issue, x_node)
-            yi = get_index(y_issue, y_node)
+    # Count the stars that have each pair of different (issue, node) flags.
+    index = FlagIndex(np.unique(flags["cname"]), flags["cname"], grid_indices)
+    pairs = index.cooccurrence().tocoo()
+    x, y = (index.flags[pairs.row], index.flags[pairs.col])
 
-            Z[xi, yi] += 1
-            Z[yi, xi] += 1
+    keep = (x != y)
+    if not show_multiple_flags_per_node:
+        keep &= (get_node_index(x) != get_node_index(y))
+    Z[x[keep], y[keep]] = pairs.data[keep]
 
 
     before_reorder = np.sort(labels[np.where(Z == Z.max())[0]])
@@ -196,30 +196,33 @@ def compare_nodes_within_wg(database, wg, parameter, extent=None,
         WHERE wg = %s""", (wg, ))
     N_nodes = len(nodes)
 
-    # Get the data.
-    results = database.retrieve_table(
-        """ SELECT  r.node_id, r.cname, r.filename, r.teff, r.e_teff, r.logg, 
-                    r.e_logg, r.feh, r.e_feh, r.xi, r.e_xi
-            FROM    results r, nodes n 
+    # Stream the data, ordered by CNAME so that each star is one column.
+    N_groups = database.retrieve(
+        """ SELECT  COUNT(DISTINCT r.cname)
+            FROM    results r, nodes n
             WHERE   n.wg = %s and n.id = r.node_id
-        """, (wg, ))
-
-    results = results.group_by("cname")
-    N_groups = len(results.groups)
+        """, (wg, ))[0][0]
 
     data = np.nan * np.ones((N_nodes, N_groups))
     error = np.nan * np.ones_like(data)
-    node_ids = np.sort(np.unique(results["node_id"]))
+    node_ids = np.sort(np.array(nodes["id"]))
 
-    indices = results.groups.indices
-    for i, start_index in enumerate(indices[:-1]):
-        end_index = indices[i + 1]
+    offset, last_cname = -1, None
+    for chunk in database.retrieve_batches(
+        """ SELECT  r.node_id, r.cname, r.{0}, r.e_{0}
+            FROM    results r, nodes n 
+            WHERE   n.wg = %s and n.id = r.node_id
+            ORDER BY r.cname
+        """.format(parameter), (wg, ), as_columns=True):
 
-        for index in range(start_index, end_index):
-            j = np.where(results["node_id"][index] == node_ids)[0][0]
+        cnames = chunk["cname"]
+        i = offset + np.cumsum(
+            np.hstack([cnames[0] != last_cname, cnames[1:] != cnames[:-1]]))
+        j = np.searchsorted(node_ids, chunk["node_id"])
 
-            data[j, i] = results[parameter][index]
-            error[j, i] = results["e_{}".format(parameter)][index]
+        data[j, i] = chunk[parameter]
+        error[j, i] = chunk["e_{}".format(parameter)]
+        offset, last_cname = i[-1], cnames[-1]
 
     # Remove axes without any data.
     use = np.any(np.isfinite(data), axis=1)
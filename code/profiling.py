@@ -0,0 +1,236 @@
+""" Instrumentation for the SQL queries that are run against the database. """
+
+import logging
+import numpy as np
+import re
+import threading
+from astropy.table import Table
+from collections import Counter
+
+logger = logging.getLogger("ges")
+
+
+_FINGERPRINT_SUBSTITUTIONS = (
+    (re.compile(r"'(?:[^']|'')*'"), "?"),           # String literals.
+    (re.compile(r"%\(\w+\)s|%s"), "?"),             # Placeholders.
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),        # Numeric literals.
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(?)"), # Lists of values.
+    (re.compile(r"\s+"), " "),
+)
+
+
+def fingerprint(query):
+    """
+    Normalise a SQL query so that statements which only differ by their literal
+    values (or placeholders) share the same fingerprint.
+
+    :param query:
+        The SQL query.
+    """
+
+    for pattern, replacement in _FINGERPRINT_SUBSTITUTIONS:
+        query = pattern.sub(replacement, query)
+    return query.strip()
+
+
+class QueryRegistry(object):
+
+    def __init__(self, slow_query_ms=None):
+        """
+        A registry of statistics for SQL statements, grouped by fingerprint.
+
+        :param slow_query_ms: [optional]
+            Statements that take at least this long (in milliseconds) are logged
+            as slow queries, and their query plan is captured.
+        """
+
+        self.slow_query_ms = slow_query_ms
+        self._statistics = {}
+        self._lock = threading.Lock()
+        return None
+
+
+    def record(self, key, taken, rows=None, caller=None):
+        """
+        Record the execution of a statement.
+
+        :param key:
+            The fingerprint of the SQL query that was executed.
+
+        :param taken:
+            The time taken to execute the query, in milliseconds.
+
+        :param rows: [optional]
+            The number of rows returned or affected.
+
+        :param caller: [optional]
+            A description of the function that executed the query.
+        """
+
+        with self._lock:
+            statistics = self._statistics.setdefault(key, {
+                "times": [], "rows": 0, "callers": Counter(), "plan": None })
+            statistics["times"].append(taken)
+            statistics["rows"] += max(rows or 0, 0)
+            statistics["callers"][caller] += 1
+        return None
+
+
+    def needs_plan(self, key, taken):
+        """
+        Return whether the query plan should be captured for a statement: it
+        was slow, and no plan has been captured for its fingerprint yet.
+
+        :param key:
+            The fingerprint of the query.
+
+        :param taken:
+            The time taken to execute the query, in milliseconds.
+        """
+
+        return self.slow_query_ms is not None and taken >= self.slow_query_ms \
+           and self._statistics.get(key, {}).get("plan", "") is None
+
+
+    def add_plan(self, key, taken, plan):
+        """
+        Store the query plan for a slow statement.
+
+        :param key:
+            The fingerprint of the query.
+
+        :param taken:
+            The time taken to execute the query, in milliseconds.
+
+        :param plan:
+            The query plan, as text.
+        """
+
+        with self._lock:
+            self._statistics[key]["plan"] = plan
+        logger.warn("Slow SQL query ({0:.0f} ms): {1}\n{2}".format(
+            taken, key, plan))
+        return None
+
+
+    def report(self):
+        """
+        Return a table of statistics for each statement fingerprint, ordered by
+        the total time spent.
+        """
+
+        rows = []
+        with self._lock:
+            for key, statistics in self._statistics.items():
+                times = np.array(statistics["times"])
+                caller = statistics["callers"].most_common(1)[0][0]
+                rows.append((key, times.size, times.sum(), times.mean(),
+                    np.percentile(times, 95), statistics["rows"],
+                    caller or "", statistics["plan"] is not None))
+
+        if not rows:
+            return None
+
+        table = Table(rows=rows, names=("Fingerprint", "N", "Total [ms]",
+            "Mean [ms]", "P95 [ms]", "Rows", "Caller", "Plan"))
+        table.sort("Total [ms]")
+        return table[::-1]
+
+
+    def log_report(self):
+        """ Log the report of statement statistics. """
+
+        table = self.report()
+        if table is None:
+            return None
+
+        logger.info("SQL query statistics:\n{}".format(
+            "\n".join(table.pformat(max_lines=-1, max_width=-1))))
+
+        for key, statistics in self._statistics.items():
+            if statistics["plan"] is not None:
+                logger.info("Query plan for {}:\n{}".format(
+                    key, statistics["plan"]))
+        return None
+
+
+class RepeatedQueryDetector(object):
+
+    def __init__(self, name, threshold=50):
+        """
+        Detect statements that are executed many times from the same place
+        within a scope (e.g., a pipeline stage), which usually means there is
+        one query per item inside a Python loop (the "N+1" query pattern).
+
+        :param name:
+            A name for the scope.
+
+        :param threshold: [optional]
+            Statements executed more than this many times from the same call
+            site are flagged.
+        """
+
+        self.name = name
+        self.threshold = threshold
+        self._counts = {}
+        self._lock = threading.Lock()
+        return None
+
+
+    def record(self, key, caller, taken):
+        """
+        Record the execution of a statement.
+
+        :param key:
+            The fingerprint of the SQL query that was executed.
+
+        :param caller:
+            A description of the function that executed the query.
+
+        :param taken:
+            The time taken to execute the query, in milliseconds.
+        """
+
+        with self._lock:
+            counts = self._counts.setdefault((key, caller), [0, 0.0])
+            counts[0] += 1
+            counts[1] += taken
+        return None
+
+
+    def report(self):
+        """
+        Return a table of the statements that were executed more times than the
+        threshold from the same call site, ordered by the total time spent.
+        """
+
+        with self._lock:
+            rows = [(self.name, key, caller or "", N, total) \
+                for (key, caller), (N, total) in self._counts.items() \
+                    if N > self.threshold]
+
+        if not rows:
+            return None
+
+        table = Table(rows=rows,
+            names=("Stage", "Fingerprint", "Caller", "N", "Total [ms]"))
+        table.sort("Total [ms]")
+        return table[::-1]
+
+
+    def log_report(self):
+        """ Log any statements that were flagged as repeated queries. """
+
+        table = self.report()
+        if table is None:
+            logger.info("No repeated queries in '{}'".format(self.name))
+            return None
+
+        for row in table:
+            logger.warn("Repeated query in '{}': executed {} times from {} "\
+                "({:.0f} ms in total): {}".format(self.name, row["N"],
+                    row["Caller"], row["Total [ms]"], row["Fingerprint"]))
+
+        logger.info("Repeated queries in '{}':\n{}".format(self.name,
+            "\n".join(table.pformat(max_lines=-1, max_width=-1))))
+        return None
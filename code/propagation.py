@@ -0,0 +1,241 @@
+""" Set-based propagation of TECH flags between results. """
+
+import logging
+import re
+from astropy.table import Table
+
+logger = logging.getLogger("ges")
+
+
+# Sections of the flags file, and the scope of the results that are affected
+# when a result has a matching flag.
+RULE_SECTIONS = (
+    ("propagate_flags_by_spectrum", "spectrum"),
+    ("propagate_flags_by_cname", "cname"),
+    ("node_specific_flags", "result"),
+)
+
+# The key for a rule that matches any TECH flag (with a constraint), rather
+# than a specific issue code.
+ANY_FLAG = "any_flag"
+
+# WG14 issue codes are five digits (e.g., 10106), or letters for some nodes
+# (e.g., ABA).
+_ISSUE_CODE = re.compile(r"^(?:\d{5}|[A-Za-z]+)$")
+
+# The first TECH flag with a given issue code (or any TECH flag) for each result
+# that matches the rule constraint, for the stars being checked (or all stars).
+_SOURCES = """
+    WITH f AS (
+        SELECT  DISTINCT ON (result_id) result_id, raw
+          FROM  result_flags
+         WHERE  kind = 'tech' {flag}
+         ORDER BY result_id, id),
+    s AS (
+        SELECT  f.result_id, f.raw, r.cname
+          FROM  f, results AS r
+         WHERE  r.id = f.result_id {constraint}
+           AND  (%(cnames)s::text[] IS NULL
+                 OR r.cname = ANY(%(cnames)s::text[]))),
+    """
+
+# The results affected by each source, for each scope.
+_TARGETS = {
+    "spectrum": """
+        p AS (
+            SELECT  DISTINCT ON (b.result_id)
+                    b.result_id, s.result_id AS source_id, s.raw
+              FROM  s, result_spectra AS a, result_spectra AS b
+             WHERE  a.result_id = s.result_id
+               AND  b.spectrum_filename = a.spectrum_filename
+             ORDER BY b.result_id, s.result_id)
+        """,
+    "cname": """
+        p AS (
+            SELECT  DISTINCT ON (t.id)
+                    t.id AS result_id, s.result_id AS source_id, s.raw
+              FROM  s, results AS t
+             WHERE  t.cname = s.cname
+             ORDER BY t.id, s.result_id)
+        """,
+    "result": """
+        p AS (
+            SELECT  s.result_id, s.result_id AS source_id, s.raw
+              FROM  s)
+        """,
+}
+
+_ASSIGNMENTS = {
+    "spectrum": """
+        propagated_tech_from_result_id = p.source_id,
+        propagated_tech = p.raw,
+        passed_quality_control = false""",
+    "cname": """
+        propagated_tech_from_result_id = p.source_id,
+        propagated_tech = p.raw,
+        passed_quality_control = false""",
+    "result": "passed_quality_control = false",
+}
+
+
+def parse_rules(qc_flags):
+    """
+    Return the flag propagation rules given in a flags file.
+
+    :param qc_flags:
+        A dictionary of the flags file contents (e.g., as read from
+        `flags.yaml`). Each section contains flags (issue codes) to match, or
+        flags with a SQL `constraint` on the results table. The `any_flag` key
+        matches results with any TECH flag, and must have a constraint.
+
+    :returns:
+        A list of (scope, flag, constraint) tuples, where `scope` is one of
+        'spectrum', 'cname', or 'result', and `flag` is `None` for rules that
+        match any TECH flag.
+
+    :raises ValueError:
+        If a flag can never match an issue code, or an `any_flag` rule has no
+        constraint.
+    """
+
+    rules = []
+    for section, scope in RULE_SECTIONS:
+        for key, value in (qc_flags.get(section, None) or {}).items():
+            if key == "no_constraint":
+                section_rules = [(scope, str(flag), None) for flag in value]
+            else:
+                section_rules = [
+                    (scope, str(key), (value or {}).get("constraint", None))]
+
+            for _, flag, constraint in section_rules:
+                if flag == ANY_FLAG:
+                    if constraint is None:
+                        raise ValueError("the '{}' rule in {} must have a "\
+                            "constraint".format(ANY_FLAG, section))
+                    rules.append((scope, None, constraint))
+
+                elif _ISSUE_CODE.match(flag) is None:
+                    raise ValueError("flag '{}' in {} can never match an "\
+                        "issue code (use '{}' with a constraint to match any "\
+                        "flag)".format(flag, section, ANY_FLAG))
+
+                else:
+                    rules.append((scope, flag, constraint))
+    return rules
+
+
+def propagate_rule(database, scope, flag, constraint=None, dry_run=False,
+    cnames=None):
+    """
+    Apply one flag rule with a single set-based statement. Results with a TECH
+    flag matching the issue code (and the constraint) are the sources, and all
+    results in the same scope that have passed quality control are marked as
+    failing it. Nothing is committed.
+
+    :param database:
+        The database.
+
+    :param scope:
+        The scope of the results affected by each source: 'spectrum' for those
+        that share any spectrum filename, 'cname' for those of the same star,
+        or 'result' for the source result only.
+
+    :param flag:
+        The issue code of the TECH flag (e.g., '10106'), or `None` to match
+        any TECH flag.
+
+    :param constraint: [optional]
+        An additional SQL constraint on the source results (aliased as `r`).
+
+    :param dry_run: [optional]
+        Count the results that would be affected, without updating them.
+
+    :param cnames: [optional]
+        Only use source results for these stars. By default all results can be
+        sources.
+
+    :returns:
+        A two-length tuple containing the number of source results, and the
+        number of results affected.
+    """
+
+    try:
+        targets, assignments = (_TARGETS[scope], _ASSIGNMENTS[scope])
+    except KeyError:
+        raise ValueError("unknown scope '{}' (available: {})".format(
+            scope, ", ".join(_TARGETS)))
+
+    if dry_run:
+        affected = """
+            u AS (
+                SELECT  p.source_id
+                  FROM  p, results AS r
+                 WHERE  r.id = p.result_id
+                   AND  r.passed_quality_control)"""
+    else:
+        affected = """
+            u AS (
+                UPDATE  results AS r
+                   SET  {assignments}
+                  FROM  p
+                 WHERE  r.id = p.result_id
+                   AND  r.passed_quality_control
+             RETURNING  p.source_id)""".format(assignments=assignments)
+
+    constraint_str = "" if constraint is None \
+        else " AND {}".format(constraint.replace("%", "%%"))
+    flag_str = "" if flag is None else "AND issue_code = %(flag)s"
+    query = _SOURCES.format(flag=flag_str, constraint=constraint_str) \
+          + targets + ", " \
+          + affected + """
+        SELECT  (SELECT count(*) FROM s), count(*)
+          FROM  u"""
+
+    N_sources, N_affected = database.retrieve(query,
+        dict(flag=None if flag is None else str(flag), cnames=cnames))[0]
+    logger.info("{} flag {} ({} scope{}): {} results from {} sources".format(
+        "Would propagate" if dry_run else "Propagated",
+        ANY_FLAG if flag is None else flag, scope,
+        "" if constraint is None else "; {}".format(constraint),
+        N_affected, N_sources))
+    return (N_sources, N_affected)
+
+
+def propagate_flags(database, rules, dry_run=False, cnames=None):
+    """
+    Apply flag propagation rules in order, with one statement per rule.
+    Nothing is committed.
+
+    :param database:
+        The database.
+
+    :param rules:
+        A list of (scope, flag, constraint) tuples, as returned by
+        `parse_rules`.
+
+    :param dry_run: [optional]
+        Count the results that would be affected, without updating them. Each
+        rule is counted against the current results, as if no earlier rule had
+        been applied.
+
+    :param cnames: [optional]
+        Only use source results for these stars. By default all results can be
+        sources.
+
+    :returns:
+        A table with the number of sources and affected results for each rule,
+        or `None` if there are no rules.
+    """
+
+    rows = []
+    for scope, flag, constraint in rules:
+        N_sources, N_affected = propagate_rule(database, scope, flag,
+            constraint, dry_run=dry_run, cnames=cnames)
+        rows.append((scope, ANY_FLAG if flag is None else flag,
+            constraint or "", N_sources, N_affected))
+
+    if not rows:
+        return None
+
+    return Table(rows=rows,
+        names=("Scope", "Flag", "Constraint", "Sources", "Affected"))
@@ -0,0 +1,336 @@
+""" Quality control checks on node results. """
+
+import logging
+import numpy as np
+
+logger = logging.getLogger("ges")
+
+
+def _group_sigmas(codes, values, N):
+    """
+    Return how many standard deviations each value is from the median of its
+    group, with all groups computed in one vectorised sweep. Non-finite values
+    are ignored, as with `np.nanmedian` and `np.nanstd`.
+
+    :param codes:
+        An integer array giving the group (from 0 to `N - 1`) of each value.
+
+    :param values:
+        An array of values.
+
+    :param N:
+        The number of groups.
+    """
+
+    values = np.asarray(values, dtype=float)
+    finite = np.isfinite(values)
+    values = np.where(finite, values, np.nan)
+
+    # Sort by group, then by value, so non-finite values come last in each group.
+    sorted_values = values[np.lexsort((values, codes))]
+    sizes = np.bincount(codes, minlength=N)
+    starts = np.cumsum(sizes) - sizes
+    n = np.bincount(codes, weights=finite, minlength=N).astype(int)
+
+    median = np.nan * np.ones(N)
+    valid = n > 0
+    median[valid] = 0.5 * (
+        sorted_values[starts[valid] + (n[valid] - 1) // 2] \
+      + sorted_values[starts[valid] + n[valid] // 2])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.bincount(codes, weights=np.where(finite, values, 0),
+            minlength=N) / n
+        residuals = np.where(finite, values - mean[codes], 0)
+        std = np.sqrt(np.bincount(codes, weights=residuals**2, minlength=N) / n)
+        return np.abs(median[codes] - values) / std[codes]
+
+
+def find_spurious_results(ids, cnames, teff, feh, either=3, both=2.5):
+    """
+    Identify results that are outliers compared to other results for the same
+    star. A result is spurious if either its effective temperature or its
+    metallicity is more than `either` standard deviations from the median for
+    that star, or if both are more than `both` standard deviations away.
+
+    :param ids:
+        The identifiers of the results.
+
+    :param cnames:
+        The CNAME (unique star identifier) of each result.
+
+    :param teff:
+        The effective temperature of each result.
+
+    :param feh:
+        The metallicity of each result.
+
+    :param either: [optional]
+        The sigma threshold for either parameter alone.
+
+    :param both: [optional]
+        The sigma threshold for both parameters together.
+
+    :returns:
+        An array of the identifiers of spurious results.
+    """
+
+    ids = np.asarray(ids)
+    if ids.size == 0:
+        return ids
+
+    unique_cnames, codes = np.unique(np.asarray(cnames), return_inverse=True)
+    N = len(unique_cnames)
+
+    teff_sigmas = _group_sigmas(codes, teff, N)
+    feh_sigmas = _group_sigmas(codes, feh, N)
+
+    with np.errstate(invalid="ignore"):
+        either_match = (teff_sigmas > either) | (feh_sigmas > either)
+        both_match = (teff_sigmas > both) & (feh_sigmas > both)
+
+    return ids[either_match | both_match]
+
+
+def spurious_results(database, either=3, both=2.5, cnames=None):
+    """
+    Identify results that have passed quality control, but are outliers
+    compared to other results for the same star (see `find_spurious_results`).
+
+    :param database:
+        A database for transactions.
+
+    :param either: [optional]
+        The sigma threshold for either parameter alone.
+
+    :param both: [optional]
+        The sigma threshold for both parameters together.
+
+    :param cnames: [optional]
+        Only consider results for these stars. By default all stars are used.
+
+    :returns:
+        An array of the identifiers of spurious results.
+    """
+
+    results = database.retrieve_table(
+        """ SELECT id, cname, teff, feh
+            FROM   results
+            WHERE  passed_quality_control
+              AND  (%(cnames)s::text[] IS NULL
+                    OR cname = ANY(%(cnames)s::text[]))""",
+        dict(cnames=cnames))
+    if results is None:
+        return np.array([], dtype=int)
+
+    spurious = find_spurious_results(results["id"], results["cname"],
+        results["teff"], results["feh"], either=either, both=both)
+    logger.info("Found {} spurious results out of {}".format(
+        len(spurious), len(results)))
+    return spurious
+
+
+def refresh_aggregates(database, cnames=None):
+    """
+    Recompute the per-spectrum and per-CNAME aggregates of results that have
+    passed quality control (the `spectrum_aggregates` and `cname_aggregates`
+    tables). Nothing is committed.
+
+    The per-CNAME aggregates are the mean and standard deviation of the
+    per-spectrum mean TEFF and FEH, which is what `peculiar_spectra` needs.
+    They are not the median or scatter of all node results for a star (e.g.,
+    as used by `model.ensemble.MedianModel`).
+
+    :param database:
+        A database for transactions.
+
+    :param cnames: [optional]
+        The CNAMEs of the stars to refresh. By default all stars are refreshed.
+    """
+
+    if cnames is not None:
+        cnames = list(set([str(cname).strip() for cname in cnames]))
+        if not cnames:
+            return None
+
+    database.execute("SELECT refresh_qc_aggregates(%s)", (cnames, ))
+    return None
+
+
+def peculiar_spectra(database, wg, sigma_discrepant=3, teff_discrepant=250,
+    feh_discrepant=1.0, and_or="and", cnames=None):
+    """
+    Identify spectra whose mean node results are discrepant from those of the
+    other spectra of the same star, using the aggregates maintained by
+    `refresh_aggregates`.
+
+    A spectrum is discrepant in a parameter if the mean for the spectrum is
+    more than `sigma_discrepant` standard deviations (of the per-spectrum means)
+    from the mean for the star, and differs by at least an absolute amount.
+
+    :param database:
+        A database for transactions.
+
+    :param wg:
+        The working group.
+
+    :param sigma_discrepant: [optional]
+        The sigma threshold for either parameter.
+
+    :param teff_discrepant: [optional]
+        The minimum absolute difference in effective temperature.
+
+    :param feh_discrepant: [optional]
+        The minimum absolute difference in metallicity.
+
+    :param and_or: [optional]
+        Whether a spectrum must be discrepant in both parameters ('and') or
+        either parameter ('or').
+
+    :param cnames: [optional]
+        Only consider spectra of these stars. By default all stars are used.
+
+    :returns:
+        A table with the identifier of one result for each peculiar spectrum,
+        and the aggregates for the spectrum and the star, or `None` if there
+        are no peculiar spectra.
+    """
+
+    and_or = and_or.strip().lower()
+    if and_or not in ("and", "or"):
+        raise ValueError("and_or must be 'and' or 'or'")
+
+    return database.retrieve_table(
+        """ SELECT  s.result_id AS id, s.cname, s.filename,
+                    s.avg_teff AS avg_filename_teff,
+                    c.avg_teff AS avg_cname_teff,
+                    c.stddev_teff AS stddev_cname_teff,
+                    s.avg_feh AS avg_filename_feh,
+                    c.avg_feh AS avg_cname_feh,
+                    c.stddev_feh AS stddev_cname_feh
+              FROM  spectrum_aggregates AS s, cname_aggregates AS c
+             WHERE  s.wg = %(wg)s
+               AND  c.wg = s.wg
+               AND  c.cname = s.cname
+               AND  (%(cnames)s::text[] IS NULL
+                     OR s.cname = ANY(%(cnames)s::text[]))
+               AND  ((abs(c.avg_teff - s.avg_teff) / (0.00001 + c.stddev_teff)
+                        > %(sigma_discrepant)s
+                      AND abs(c.avg_teff - s.avg_teff) >= %(teff_discrepant)s)
+                {and_or}
+                     (abs(c.avg_feh - s.avg_feh) / (0.00001 + c.stddev_feh)
+                        > %(sigma_discrepant)s
+                      AND abs(c.avg_feh - s.avg_feh) >= %(feh_discrepant)s))
+             ORDER BY s.cname ASC""".format(and_or=and_or.upper()),
+        dict(wg=wg, sigma_discrepant=sigma_discrepant,
+            teff_discrepant=teff_discrepant, feh_discrepant=feh_discrepant,
+            cnames=cnames))
+
+
+def dirty_cnames(database):
+    """
+    Return the stars that are queued for quality control because their node
+    results have changed (see the `dirty_cnames` table).
+
+    :param database:
+        A database for transactions.
+
+    :returns:
+        A list of `(cname, marked)` tuples, where `marked` is the time that
+        the star was last queued. Pass these to `clear_dirty_cnames` once the
+        stars have been re-evaluated.
+    """
+
+    return database.retrieve("SELECT cname, marked FROM dirty_cnames") or []
+
+
+def related_cnames(database, cnames):
+    """
+    Return the given stars and any other stars that are connected to them
+    through results that share a spectrum (directly, or through other stars),
+    since flags propagated by spectrum can cross between those stars.
+
+    :param database:
+        A database for transactions.
+
+    :param cnames:
+        The CNAMEs of the stars.
+    """
+
+    cnames = list(set(cnames))
+    if not cnames:
+        return []
+
+    rows = database.retrieve(
+        """ WITH RECURSIVE c (cname) AS (
+                SELECT  unnest(%s::text[])
+                 UNION
+                SELECT  t.cname
+                  FROM  c, results AS r, result_spectra AS a,
+                        result_spectra AS b, results AS t
+                 WHERE  r.cname = c.cname
+                   AND  a.result_id = r.id
+                   AND  b.spectrum_filename = a.spectrum_filename
+                   AND  t.id = b.result_id)
+            SELECT cname FROM c""", (cnames, ))
+    return [cname for cname, in rows]
+
+
+def reset_quality_control(database, cnames=None):
+    """
+    Clear any propagated flags and mark results as having passed quality
+    control, before the quality control rules are applied again. Nothing is
+    committed.
+
+    :param database:
+        A database for transactions.
+
+    :param cnames: [optional]
+        Only reset results for these stars. By default all results are reset.
+
+    :returns:
+        The number of results that were reset.
+    """
+
+    return database.update(
+        """ UPDATE  results
+               SET  propagated_tech_from_result_id = null,
+                    propagated_peculi_from_result_id = null,
+                    propagated_remark_from_result_id = null,
+                    propagated_tech = '',
+                    propagated_peculi = '',
+                    propagated_remark = '',
+                    passed_quality_control = true
+             WHERE  passed_quality_control = false
+               AND  (%(cnames)s::text[] IS NULL
+                     OR cname = ANY(%(cnames)s::text[]))""",
+        dict(cnames=cnames))
+
+
+def clear_dirty_cnames(database, queued):
+    """
+    Remove stars from the quality control queue once they have been
+    re-evaluated. Only the exact `(cname, marked)` entries that were read are
+    removed, so stars that were queued again while quality control was
+    running are kept. Nothing is committed.
+
+    :param database:
+        A database for transactions.
+
+    :param queued:
+        A list of `(cname, marked)` tuples, as returned by `dirty_cnames`.
+
+    :returns:
+        The number of stars removed from the queue.
+    """
+
+    if not queued:
+        return 0
+
+    return database.update(
+        """ DELETE FROM dirty_cnames AS d
+             USING  unnest(%s::text[], %s::timestamp[]) AS q (cname, marked)
+             WHERE  d.cname = q.cname
+               AND  d.marked = q.marked""",
+        ([cname for cname, marked in queued],
+            [marked for cname, marked in queued]))
@@ -0,0 +1,205 @@
+""" Versioned migrations for the database schema. """
+
+import json
+import logging
+import os
+import re
+from glob import glob
+
+logger = logging.getLogger("ges")
+
+MIGRATIONS_PATH = os.path.join(os.path.dirname(__file__), "migrations")
+
+# Migration files are named like 0001_description.sql
+_MIGRATION_FILENAME = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+# Queries that the pipeline runs many times, and that must be able to use an
+# index instead of a sequential scan on the tables listed.
+KEY_QUERIES = (
+    (""" SELECT results.id, node_id, filename, teff, e_teff
+           FROM results, nodes
+          WHERE results.node_id = nodes.id
+            AND nodes.wg = 1
+            AND results.cname = 'X'
+            AND results.passed_quality_control""", ("results", )),
+    (""" SELECT r.id, r.teff
+           FROM results AS r
+          WHERE r.node_id = 1
+            AND r.cname = 'X'""", ("results", )),
+    (""" SELECT id
+           FROM results
+          WHERE filename = 'X'""", ("results", )),
+    (""" SELECT id
+           FROM results
+          WHERE NOT passed_quality_control""", ("results", )),
+    (""" SELECT id, filename
+           FROM spectra
+          WHERE cname = 'X'""", ("spectra", )),
+    (""" SELECT id, cname
+           FROM spectra
+          WHERE ges_fld = 'X'""", ("spectra", )),
+    (""" SELECT id
+           FROM wg_recommended_results
+          WHERE wg = 1
+            AND cname = 'X'""", ("wg_recommended_results", )),
+    (""" SELECT result_id
+           FROM result_flags
+          WHERE kind = 'tech'
+            AND issue_code = 'X'""", ("result_flags", )),
+    (""" SELECT t.result_id
+           FROM result_spectra AS s, result_spectra AS t
+          WHERE s.result_id = 1
+            AND t.spectrum_filename = s.spectrum_filename""",
+        ("result_spectra", )),
+    (""" SELECT s.result_id, c.avg_teff, c.stddev_teff
+           FROM spectrum_aggregates AS s, cname_aggregates AS c
+          WHERE s.cname = 'X'
+            AND c.wg = s.wg
+            AND c.cname = s.cname""",
+        ("spectrum_aggregates", "cname_aggregates")),
+)
+
+
+def available_migrations(path=None):
+    """
+    Return the migrations that are available, ordered by version.
+
+    :param path: [optional]
+        The directory that contains the migration files.
+
+    :returns:
+        A list of (version, name, filename) tuples.
+    """
+
+    migrations = []
+    for filename in glob(os.path.join(path or MIGRATIONS_PATH, "*.sql")):
+        match = _MIGRATION_FILENAME.match(os.path.basename(filename))
+        if match is None:
+            logger.warn("Ignoring unexpected migration file {}".format(filename))
+            continue
+        migrations.append((int(match.group(1)), match.group(2), filename))
+
+    versions = [version for version, name, filename in migrations]
+    if len(set(versions)) != len(versions):
+        raise ValueError("duplicate migration versions in {}".format(
+            path or MIGRATIONS_PATH))
+    return sorted(migrations)
+
+
+def schema_version(database):
+    """
+    Return the version of the most recent migration applied to the database,
+    or zero if no migrations have been applied.
+
+    :param database:
+        The database.
+    """
+
+    database.execute(
+        """ CREATE TABLE IF NOT EXISTS schema_version (
+                version integer primary key,
+                name text not null,
+                applied timestamp default now())""")
+    return database.retrieve(
+        "SELECT COALESCE(MAX(version), 0) FROM schema_version")[0][0]
+
+
+def migrate(database, path=None, target=None):
+    """
+    Apply any migrations that have not yet been applied to the database. Each
+    migration is applied and recorded in the `schema_version` table in its own
+    transaction.
+
+    :param database:
+        The database.
+
+    :param path: [optional]
+        The directory that contains the migration files.
+
+    :param target: [optional]
+        Only apply migrations up to (and including) this version.
+
+    :returns:
+        A list of the versions that were applied.
+    """
+
+    current = schema_version(database)
+    database.connection.commit()
+
+    applied = []
+    for version, name, filename in available_migrations(path):
+        if version <= current or (target is not None and version > target):
+            continue
+
+        logger.info("Applying schema migration {} ({})".format(version, name))
+        with open(filename, "r") as fp:
+            sql = fp.read()
+
+        with database.transaction():
+            database.execute(sql)
+            database.execute(
+                "INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                (version, name))
+        applied.append(version)
+
+    if not applied:
+        logger.info("Database schema is up to date (version {})".format(
+            current))
+    return applied
+
+
+def _sequential_scans(plan):
+    """
+    Return the names of the relations that are read by sequential scans in a
+    query plan.
+
+    :param plan:
+        A node from a JSON-formatted query plan.
+    """
+
+    relations = []
+    if plan.get("Node Type") == "Seq Scan":
+        relations.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        relations.extend(_sequential_scans(child))
+    return relations
+
+
+def check_query_plans(database, queries=None):
+    """
+    Check that key pipeline queries can use indexes instead of sequential scans.
+
+    Sequential scans are disabled in the planner while each query is explained,
+    so a sequential scan is only chosen when no usable index exists. This makes
+    the check independent of how many rows are in the tables.
+
+    :param database:
+        The database.
+
+    :param queries: [optional]
+        A list of (query, tables) tuples, where `tables` are the relations that
+        must not be read by a sequential scan. Defaults to `KEY_QUERIES`.
+
+    :returns:
+        A list of (query, relation) tuples for each sequential scan found.
+    """
+
+    failures = []
+    with database.transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        for query, tables in (queries or KEY_QUERIES):
+            cursor.execute("EXPLAIN (FORMAT JSON) {}".format(query))
+            plan = cursor.fetchone()[0]
+            if not isinstance(plan, list):
+                plan = json.loads(plan)
+
+            for relation in _sequential_scans(plan[0]["Plan"]):
+                if relation in tables:
+                    logger.warn("Sequential scan on {} for query: {}".format(
+                        relation, " ".join(query.split())))
+                    failures.append((query, relation))
+        cursor.close()
+        connection.rollback()
+
+    return failures
@@ -3,6 +3,27 @@
     Schema description for the GES/CoRoT project.
 */
 
+/* Indexes are created by the numbered files in code/migrations/ */
+DROP TABLE IF EXISTS schema_version;
+DROP TABLE IF EXISTS result_flags;
+DROP TABLE IF EXISTS result_spectra;
+DROP TABLE IF EXISTS spectrum_aggregates;
+DROP TABLE IF EXISTS cname_aggregates;
+DROP TABLE IF EXISTS dirty_cnames;
+
+DROP TABLE IF EXISTS ingest_manifest;
+CREATE TABLE ingest_manifest (
+    path text not null,
+    tablename text not null,
+    size bigint not null,
+    mtime double precision not null,
+    sha1 char(40) not null,
+    n_rows integer,
+    ingested timestamp default now()
+);
+ALTER TABLE ingest_manifest ADD COLUMN id BIGSERIAL PRIMARY KEY;
+CREATE UNIQUE INDEX single_manifest_entry_per_path ON ingest_manifest (path);
+
 DROP TABLE IF EXISTS spectra;
 CREATE TABLE spectra (
     cname char(16) not null,
@@ -293,3 +314,9 @@ ALTER TABLE wg_recommended_results ADD COLUMN m_loops integer;
 ALTER TABLE wg_recommended_results ADD COLUMN m_name char(1);
 
 ALTER TABLE spectra ADD COLUMN is_blind_test boolean default false;
+
+ALTER TABLE spectra ADD COLUMN ingest_id integer;
+ALTER TABLE recommended_idr4 ADD COLUMN ingest_id integer;
+ALTER TABLE results ADD COLUMN ingest_id integer;
+ALTER TABLE wg_recommended_results ADD COLUMN ingest_id integer;
+CREATE INDEX results_ingest_id ON results (ingest_id);
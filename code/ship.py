@@ -134,9 +134,9 @@ def homogenised_catalog(database, input_path, output_path, wg, ext=-1,
         record = database.retrieve_table(
             """ SELECT {columns}
                   FROM wg_recommended_results
-                 WHERE wg = '{wg}'
-                   AND cname = '{cname}'
-            """.format(wg=wg, cname=cname, columns=", ".join(columns)))
+                 WHERE wg = %s
+                   AND cname = %s
+            """.format(columns=", ".join(columns)), (wg, cname), prepare=True)
 
         if record is None:
             # Keep whatever is currently there in the template.
@@ -207,38 +207,36 @@ def homogenised_catalog(database, input_path, output_path, wg, ext=-1,
 
         if np.isfinite(updated_data["teff"][i]):
             record = database.retrieve_table(
-                """ SELECT w.id, string_agg(DISTINCT r.tech, '|') AS tech
+                """ SELECT string_agg(DISTINCT f.raw, '|' ORDER BY f.raw) AS tech
                     FROM wg_recommended_results AS w,
-                         results as r
+                         result_flags as f
                     WHERE w.wg = %s
-                      AND r.id = ANY(
+                      AND f.result_id = ANY(
                               w.provenance_ids_for_teff ||
                               w.provenance_ids_for_logg ||
                               w.provenance_ids_for_feh)
-                      AND r.tech <> 'NaN'
-                      AND r.tech <> ''
-                      AND w.cname = %s
-                    GROUP BY w.id;
-                """, (wg, cname))
+                      AND f.kind = 'tech'
+                      AND w.cname = %s;
+                """, (wg, cname), prepare=True)
 
         else:
             record = database.retrieve_table(
-                """ SELECT string_agg(DISTINCT r.tech, '|') AS tech
+                """ SELECT string_agg(DISTINCT f.raw, '|' ORDER BY f.raw) AS tech
                     FROM results as r,
-                         nodes as n
+                         nodes as n,
+                         result_flags as f
                     WHERE r.node_id = n.id
                       AND n.wg = %s
                       AND r.cname = %s
-                      AND r.tech <> 'NaN'
-                      AND r.tech <> '';
-                """, (wg, cname))
+                      AND f.result_id = r.id
+                      AND f.kind = 'tech';
+                """, (wg, cname), prepare=True)
 
-        if record is None:
+        if record is None or not record["tech"][0]:
             concatenated_tech.append("")
 
         else:
-            tech = "|".join(sorted(map(str.strip, list(set(record["tech"][0].split("|"))))))
-            tech = tech.strip(" |")
+            tech = record["tech"][0]
             concatenated_tech.append(tech)
 
             max_length = max([max_length, len(tech)])
@@ -3,7 +3,6 @@
 
 
 import numpy as np
-from collections import Counter
 from astropy.table import Table
 
 import utils
@@ -108,7 +107,7 @@ def stellar_parameter_summary(database, wg=None):
 
 
 
-def tech_flags(database, wg, node_name, column="TECH"):
+def tech_flags(database, wg, node_name, column="TECH", flag_index=None):
     """
     Produce a summary table outlining the number of times certain flags were
     used.
@@ -122,6 +121,10 @@ def tech_flags(database, wg, node_name, column="TECH"):
     :param node_name:
         The name of the node to summarize results for.
 
+    :param flag_index: [optional]
+        A `FlagIndex` of the raw flags (of the kind given by `column`) for all
+        results, to count flags from instead of querying the database. This is
+        faster when summarising many nodes.
     """
 
     # FLAG / TOTAL_COUNT
@@ -129,15 +132,31 @@ def tech_flags(database, wg, node_name, column="TECH"):
 
     node_id = database.retrieve_node_id(wg, node_name)
 
-    flags = database.retrieve_table(
-        """SELECT {} FROM results WHERE node_id = %s""".format(column),
-        (node_id, ))
+    if flag_index is not None:
+        mask = (flag_index.node_ids == node_id)
+        counts = flag_index.counts(mask)
+        used = np.where(counts > 0)[0]
+        used = used[np.argsort(counts[used])[::-1]]
+        rows = [(flag_index.flags[i], counts[i]) for i in used]
+        N = mask.sum()
 
-    if flags is None: return None
+    else:
+        rows = database.retrieve(
+            """ SELECT f.raw, COUNT(DISTINCT f.result_id) AS n
+                  FROM results AS r, result_flags AS f
+                 WHERE r.node_id = %s
+                   AND f.result_id = r.id
+                   AND f.kind = %s
+              GROUP BY f.raw
+              ORDER BY n DESC""", (node_id, column.lower()))
+        N = None
 
-    counts = Counter([each.strip() \
-        for each in "|".join([flag or "" for flag in flags["tech"]]).split("|") if each.strip()])
-    rows = sorted(counts.iteritems(), key=lambda (k, v): v)[::-1]
     if not rows:
-        rows = [("None", len(flags))]
+        if N is None:
+            N = database.retrieve(
+                "SELECT COUNT(*) FROM results WHERE node_id = %s",
+                (node_id, ))[0][0]
+        if N == 0: return None
+        rows = [("None", N)]
+
     return Table(rows=rows, names=("{} FLAG".format(column.upper()), "N"))
@@ -1,10 +1,12 @@
 
 """ General utility functions. """
 
+import hashlib
 import logging
 import os
 from astropy.io import fits
-from numpy import isfinite
+from collections import OrderedDict
+from numpy import array, isfinite
 
 logger = logging.getLogger("ges")
 
@@ -15,6 +17,57 @@ def safe_int(x, fill_value=-1):
         return fill_value
 
 
+def file_hash(filename, blocksize=2**20):
+    """
+    Return the SHA-1 hash of the contents of a file.
+
+    :param filename:
+        The local path of the file.
+
+    :param blocksize: [optional]
+        The number of bytes to read at a time.
+    """
+
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as fp:
+        for block in iter(lambda: fp.read(blocksize), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def read_fits_blocks(filename, columns, extension=-1, blocksize=10000):
+    """
+    Read a FITS binary table in blocks of rows, yielding only the columns that
+    are requested. The file is memory-mapped, so only one block of the table is
+    held in memory at any time.
+
+    :param filename:
+        The local path of the FITS file.
+
+    :param columns:
+        The names of the columns to read.
+
+    :param extension: [optional]
+        The HDU extension that contains the binary table.
+
+    :param blocksize: [optional]
+        The maximum number of rows in each block.
+
+    :returns:
+        A generator that yields an ordered dictionary for each block, with the
+        column names as keys and arrays of values.
+    """
+
+    with fits.open(filename, memmap=True) as image:
+        data = image[extension].data
+        N = 0 if data is None else len(data)
+        for start in range(0, N, blocksize):
+            rows = data[start:start + blocksize]
+            yield OrderedDict(
+                [(column, array(rows.field(column))) for column in columns])
+            del rows
+
+
 def wg_as_int(wg):
     return int(str(wg).strip().lower().lstrip("wg"))
 
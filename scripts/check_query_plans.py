@@ -0,0 +1,27 @@
+#!/usr/bin/python
+
+""" Check that the key pipeline queries use indexes, not sequential scans. """
+
+import logging
+import sys
+import yaml
+
+from code import GESDatabase, schema
+
+
+logger = logging.getLogger("ges")
+
+# Create a database object.
+db_filename = "db.yaml"
+with open(db_filename, "r") as fp:
+    credentials = yaml.load(fp)
+database = GESDatabase(**credentials)
+
+failures = schema.check_query_plans(database)
+if failures:
+    logger.error("{} of {} key queries use sequential scans".format(
+        len(failures), len(schema.KEY_QUERIES)))
+    sys.exit(1)
+
+logger.info("All {} key queries can use indexes".format(
+    len(schema.KEY_QUERIES)))
@@ -93,9 +93,11 @@ for wg in wgs:
             model.write(model_path, overwrite=True)
 
 
-        model.homogenise_stars_matching_query(
-            "SELECT DISTINCT ON (cname) cname FROM results WHERE setup LIKE 'GIRAFFE%'",
-            sql_constraint="setup like 'GIRAFFE%'")
+        with database.query_scope(
+            "homogenise GIRAFFE WG{} {}".format(wg, parameter)):
+            model.homogenise_stars_matching_query(
+                "SELECT DISTINCT ON (cname) cname FROM results WHERE setup LIKE 'GIRAFFE%'",
+                sql_constraint="setup like 'GIRAFFE%'")
 
 
 
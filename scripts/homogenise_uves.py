@@ -94,7 +94,9 @@ for wg in wgs:
             model.write(model_path, overwrite=True)
 
 
-        model.homogenise_stars_matching_query(
-            "SELECT DISTINCT ON (cname) cname FROM results WHERE setup LIKE 'UVES%'",
-            sql_constraint="setup like 'UVES%'")
+        with database.query_scope(
+            "homogenise UVES WG{} {}".format(wg, parameter)):
+            model.homogenise_stars_matching_query(
+                "SELECT DISTINCT ON (cname) cname FROM results WHERE setup LIKE 'UVES%'",
+                sql_constraint="setup like 'UVES%'")
 
@@ -8,6 +8,7 @@ import matplotlib.pyplot as plt
 from glob import glob
 
 from code import (GESDatabase, plot, summary)
+from code.flagindex import FlagIndex
 from astropy.table import Table
 
 # Initialize logging.
@@ -24,7 +25,7 @@ logger.addHandler(handler)
 db_filename = "db.yaml"
 with open(db_filename, "r") as fp:
     credentials = yaml.load(fp)
-database = GESDatabase(**credentials)
+database = GESDatabase(result_cache_bytes=512 * 1024**2, **credentials)
 
 
 prefix = "ges-corot"
@@ -35,7 +36,7 @@ extents = dict(teff=(4000, 6500), logg=(0, 5), feh=(-3, 0.5))
 isochrones = glob("isochrones/*.dat")
 
 # Create node-level folders.
-nodes = database.retrieve_table("SELECT id, wg, TRIM(name) as name FROM nodes")
+nodes = database.retrieve_table("SELECT id, wg, name FROM nodes")
 for node in nodes:
     folder = "figures/qc/wg{}/{}".format(node["wg"], node["name"])
     if not os.path.exists(folder):
@@ -299,9 +300,11 @@ parameter_ranges = summary.stellar_parameter_range(database)
 parameter_ranges.write("figures/qc/parameter-range-summary.txt",
     format="ascii")
 
+tech_flag_index = FlagIndex.from_database(database, kind="tech", column="raw")
 for node in nodes:
 
-    tech = summary.tech_flags(database, node["wg"], node["name"])
+    tech = summary.tech_flags(database, node["wg"], node["name"],
+        flag_index=tech_flag_index)
     if tech is not None:
         tech.write(
             "figures/{prefix}-{wg}-{name}-tech-summary.txt".format(
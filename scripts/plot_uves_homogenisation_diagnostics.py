@@ -21,7 +21,7 @@ logger = logging.getLogger("ges_corot")
 db_filename = "db.yaml"
 with open(db_filename, "r") as fp:
     credentials = yaml.load(fp)
-database = GESDatabase(**credentials)
+database = GESDatabase(result_cache_bytes=512 * 1024**2, **credentials)
 
 wg = 1
 parameters = ("feh", "teff", "feh")
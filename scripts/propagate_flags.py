@@ -2,13 +2,22 @@
 
 """
 Propagate relevant flag information from one node to others.
+
+Quality control is only re-run for the stars queued in the `dirty_cnames` table
+(those with node results that have changed since it was last run), and for any
+stars that share spectra with them. Use --all to re-run it for every star
+(e.g., after flags.yaml has changed).
+
+Use --dry-run to report how many results each rule in flags.yaml would affect,
+without changing anything.
 """
 
 import logging
-import numpy as np
+import sys
 import yaml
+from collections import Counter
 
-from code import GESDatabase
+from code import GESDatabase, propagation, quality
 from code.gesdb import UnknownNodeError
 
 # Connect to database.
@@ -25,19 +34,39 @@ logger = logging.getLogger("ges")
 with open("flags.yaml", "r") as fp:
     qc_flags = yaml.load(fp)
 
+# Report what the flag rules would do to the current results, without writing.
+if "--dry-run" in sys.argv[1:]:
+    propagation_summary = propagation.propagate_flags(database,
+        propagation.parse_rules(qc_flags), dry_run=True)
+    if propagation_summary is not None:
+        propagation_summary.pprint(max_lines=-1, max_width=-1)
+    sys.exit(0)
+
+
+# Find the stars that need quality control.
+queued = quality.dirty_cnames(database)
+queued_cnames = [cname for cname, marked in queued]
+if "--all" in sys.argv[1:]:
+    cnames = None
+    logger.info("Running quality control for all stars")
+
+elif not queued_cnames:
+    logger.info("No stars are queued for quality control")
+    sys.exit(0)
+
+else:
+    cnames = quality.related_cnames(database, queued_cnames)
+    logger.info("Running quality control for {} stars ({} queued)".format(
+        len(cnames), len(queued_cnames)))
+
 
 # Clear any previous propagations before starting.
 logger.info("Clearing previous propagations and setting all to have passed_quality_control = True")
-database.update(
-    """ UPDATE  results
-           SET  propagated_tech_from_result_id = null,
-                propagated_peculi_from_result_id = null,
-                propagated_remark_from_result_id = null,
-                propagated_tech = '',
-                propagated_peculi = '',
-                propagated_remark = '',
-                passed_quality_control = true
-         WHERE  passed_quality_control = false;""")
+quality.reset_quality_control(database, cnames)
+
+# Every result has passed quality control again, so the per-spectrum and
+# per-CNAME aggregates need to be recomputed.
+quality.refresh_aggregates(database, cnames)
 
 database.connection.commit()
 
@@ -50,222 +79,48 @@ for wg in (1, ):
 
     logger.info("Querying for peculiar spectra in WG{}".format(wg))
 
-    kwds = dict(wg=wg)
-    kwds.update(peculiar_spectra_kwds)
-
-    peculiar_spectrum_query = """
-        with t4 as (
-        select id, cname, filename, avg_filename_teff, avg_cname_teff, stddev_cname_teff, abs((avg_cname_teff - avg_filename_teff)/(0.00001 + stddev_cname_teff)) as abs_sigma_teff_discrepant, avg_filename_feh, avg_cname_feh, stddev_cname_feh, abs((avg_cname_feh - avg_filename_feh)/(0.00001 + stddev_cname_feh)) as abs_sigma_feh_discrepant FROM (with ar as (select distinct on (filename) id, cname, trim(filename) as filename, avg(teff) over w as avg_filename_teff, avg(feh) over w as avg_filename_feh from (with n as (select id from nodes where wg = {wg}) select distinct on (r.filename, r.node_id) r.id, r.cname, trim(r.filename) as filename, r.node_id, teff, feh from n, results as r where r.node_id = n.id and teff <> 'NaN' or feh <> 'NaN') t window w as (partition by filename)) select ar.id, ar.cname, ar.filename, ar.avg_filename_teff, avg(avg_filename_teff) over w2 as avg_cname_teff, stddev(avg_filename_teff) over w2 as stddev_cname_teff, ar.avg_filename_feh, avg(avg_filename_feh) over w2 as avg_cname_feh, stddev(avg_filename_feh) over w2 as stddev_cname_feh FROM ar window w2 as (partition by cname)) t3)
-        select * from t4 where (t4.abs_sigma_teff_discrepant > {sigma_discrepant} and t4.abs_sigma_teff_discrepant <> 'NaN' and abs(t4.avg_cname_teff - avg_filename_teff) >= {teff_discrepant}) {and_or} (t4.abs_sigma_feh_discrepant > {sigma_discrepant} and abs(t4.avg_cname_feh - t4.avg_filename_feh) >= {feh_discrepant} and t4.abs_sigma_feh_discrepant <> 'NaN') order by cname asc;""".format(
-            **kwds)
-
-    peculiar_spectra = database.retrieve_table(peculiar_spectrum_query)
+    peculiar_spectra = quality.peculiar_spectra(database, wg, cnames=cnames,
+        **peculiar_spectra_kwds)
     if peculiar_spectra is None: continue
 
     N_peculiar_spectra[wg] = len(peculiar_spectra)
 
     for row in peculiar_spectra:
-
-        filenames = row["filename"].strip().split("|")
         logger.info("Propagating {}/{}/{}".format(
             row["id"], row["cname"], row["filename"]))
 
-        n = 0
-        for filename in filenames:
-            n += database.update(
-                """ UPDATE results
-                       SET propagated_tech = '10106-{}-00-00-A',
-                           propagated_tech_from_result_id = '{}',
-                           passed_quality_control = false
-                     WHERE filename LIKE '%{}%';""".format(
-                        wg, int(row["id"]), filename))
-
-        if n > 0:
-            logger.info("--> affected {} results".format(n))
-
-database.connection.commit()
-
-
-# PROPAGATE BY SPECTRUM
-def propagate_by_spectrum(flag, constraint=None, commit=False):
-    
-    constraint_str = "" if constraint is None else " AND {}".format(constraint)
-    affected = database.retrieve_table(
-        """ SELECT  id, TRIM(filename) AS filename, TRIM(tech) as tech
-            FROM    results
-            WHERE   (tech LIKE '%{0}-%' OR TRIM(TECH) = '{0}') {1}
-        """.format(flag, constraint_str))
-    
-    if affected is None:
-        return 0
-
-    N = 0
-    for row in affected:
-    
-        # Each row can have multiple TECH flags, so first identify the TECH flag
-        # that PostgreSQL matched on.
-        tech_flags = row["tech"].strip().split("|")
-        for tech_flag in tech_flags:
-            if "{}-".format(flag) in tech_flag:
-                matched_tech_flag = tech_flag
-                break
-
-        else:
-            raise ValueError(
-                "cannot identify tech flag {} from the SQL match: {}".format(
-                    flag, row["tech"].strip()))
-
-
-        # Update other results using the same filename(s).
-        filenames = row["filename"].strip().split("|")
-        for j, filename in enumerate(filenames):
-            if not filename: continue
-
-            n = database.update(
-                """ UPDATE  results
-                    SET     propagated_tech_from_result_id = '{}',
-                            propagated_tech = '{}',
-                            passed_quality_control = false
-                    WHERE   filename LIKE '%{}%'
-                      AND   passed_quality_control = true
-                """.format(
-                    int(row["id"]), matched_tech_flag, filename))
-            
-            N += n
-
-            if n > 0:
-                logger.info("Propagated ({}/{}/{}) to {} other entries".format(
-                    row["id"], matched_tech_flag, filename, n))    
-
-    if commit:
-        database.connection.commit()
-
-    return N
-
-
-# PROPAGATE BY SPECTRUM
-N_propagations = {}
-
-for key, value in qc_flags.get("propagate_flags_by_spectrum", {}).items():
-    if key == "no_constraint":
-        for flag in value:
-            N_propagations.setdefault(flag, 0)
-            N_propagations[flag] += propagate_by_spectrum(flag, None)
-    
-    else:
-        flag = key
-        constraint = value.get("constraint", None)
-        N_propagations.setdefault(flag, 0)
-        N_propagations[flag] += propagate_by_spectrum(flag, constraint)
-
-database.connection.commit()
-
-
-# PROPAGATE BY CNAME
-def propagate_by_cname(flag, constraint=None, commit=False):
-
-    constraint_str = "" if constraint is None else " AND {}".format(constraint)
-    affected = database.retrieve_table(
-        """ SELECT  id, cname, TRIM(tech) as tech
-              FROM  results
-             WHERE  (tech LIKE '%{0}-%' OR TRIM(tech) = '{0}') {1}
-        """.format(flag, constraint_str))
-
-    if affected is None:
-        return 0
-
-    N = 0
-    for row in affected:
-        # Each row can have multiple TECH flags, so first identify the TECH flag
-        # that PostgreSQL matched on.
-        tech_flags = row["tech"].strip().split("|")
-        for tech_flag in tech_flags:
-            if "{}-".format(flag) in tech_flag:
-                matched_tech_flag = tech_flag
-                break
-
-        else:
-            raise ValueError(
-                "cannot identify tech flag {} from the SQL match: {}".format(
-                    flag, row["tech"].strip()))
-
-        # Update other results matching this CNAME.
-        n = database.update(
-            """ UPDATE  results
-                   SET  propagated_tech_from_result_id = '{}',
-                        propagated_tech = '{}',
-                        passed_quality_control = false
-                 WHERE  cname = '{}'
-                   AND  passed_quality_control = true;
-            """.format(int(row["id"]), matched_tech_flag, row["cname"]))
-        N += n
-
+    # Flag every result that shares a spectrum with a peculiar one.
+    propagated = database.retrieve(
+        """ UPDATE results AS r
+               SET propagated_tech = %s,
+                   propagated_tech_from_result_id = p.source_id,
+                   passed_quality_control = false
+              FROM (SELECT  DISTINCT ON (t.result_id)
+                            t.result_id, s.result_id AS source_id
+                      FROM  result_spectra AS s, result_spectra AS t
+                     WHERE  s.result_id = ANY(%s)
+                       AND  t.spectrum_filename = s.spectrum_filename
+                     ORDER BY t.result_id, s.result_id) AS p
+             WHERE r.id = p.result_id
+         RETURNING p.source_id""",
+        ("10106-{}-00-00-A".format(wg),
+            [int(result_id) for result_id in peculiar_spectra["id"]]))
+
+    affected = Counter([source_id for source_id, in propagated])
+    for result_id, n in affected.items():
         if n > 0:
-            logger.info("Propagated ({}/{}/{}) to {} other entries".format(
-                row["id"], matched_tech_flag, row["cname"], n))
-
-    if commit:
-        database.connection.commit()
-
-    return N
-
-
-# PROPAGATE BY CNAME
-for key, value in qc_flags.get("propagate_flags_by_cname", {}).items():
-
-    if key == "no_constraint":
-        for flag in value:
-            N_propagations.setdefault(flag, 0)
-            N_propagations[flag] += propagate_by_cname(flag, None)
-
-    else:
-        flag = key
-        constraint = value.get("constraint", None)
-        N_propagations.setdefault(flag, 0)
-        N_propagations[flag] += propagate_by_cname(flag, constraint)
+            logger.info("--> {} affected {} results".format(result_id, n))
 
 database.connection.commit()
 
 
-# NODE-SPECIFIC FLAGS
-N_marked_as_poor_quality = {}
-for key, value in qc_flags.get("node_specific_flags", {}).items():
-
-    if key == "no_constraint":
-        for flag in value:
-            N_marked_as_poor_quality.setdefault(flag, 0)
-            N = database.update(
-                """ UPDATE  results
-                       SET  passed_quality_control = false
-                     WHERE  (tech LIKE '%{0}-%' OR trim(tech) = '{0}')
-                       AND  passed_quality_control = true;
-                """.format(flag))
-            N_marked_as_poor_quality[flag] += N
-
-            if N > 0:
-                logger.info(
-                    "Marked {} results as poor quality due to matching flag {}"\
-                    .format(N, flag))
-    else:
-        flag = key
-        constraint = value.get("constraint", None)
-        constraint_str = "" if constraint is None else " AND {}".format(constraint)
-        N_marked_as_poor_quality.setdefault(flag, 0)
-
-        N = database.update(
-            """ UPDATE  results
-                   SET  passed_quality_control = false
-                 WHERE  (tech LIKE '%{0}-%' OR trim(tech) = '{0}')
-                   AND  passed_quality_control = true
-                   {1};
-            """.format(flag, constraint_str))
-        N_marked_as_poor_quality[flag] += N
-
-        if N > 0:
-            logger.info(
-                "Marked {} results as poor quality due to matching flag {} "\
-                "and constraint {}".format(N, flag, constraint))
-
+# Propagate flags to other results of the same spectrum or star, and mark
+# results with node-specific flags, with one statement per rule.
+flag_rules = propagation.parse_rules(qc_flags)
+propagation_summary = propagation.propagate_flags(database, flag_rules,
+    cnames=cnames)
+if propagation_summary is not None:
+    propagation_summary.pprint(max_lines=-1, max_width=-1)
 
 database.connection.commit()
 
@@ -280,8 +135,12 @@ except UnknownNodeError:
 
 else:
     database.execute(
-        "UPDATE results SET passed_quality_control = false WHERE node_id = %s", 
-        (node_id, ))
+        """ UPDATE  results
+               SET  passed_quality_control = false
+             WHERE  node_id = %(node_id)s
+               AND  (%(cnames)s::text[] IS NULL
+                     OR cname = ANY(%(cnames)s::text[]))""",
+        dict(node_id=node_id, cnames=cnames))
 
 """
 # Remove all Elena/Carmela results because they are +/- (50*n) K multiples offset
@@ -305,10 +164,9 @@ contributing_node_ids = database.retrieve_table(
         WHERE (teff <> 'NaN' AND passed_quality_control) 
     """)["node_id"]
 
-all_node_ids = database.retrieve_table("SELECT id FROM nodes")["id"]
+all_node_ids = database.node_registry[0].keys()
 superfluous_node_ids = list(set(all_node_ids).difference(contributing_node_ids))
-for node_id in superfluous_node_ids:
-    database.execute("DELETE FROM nodes WHERE id = %s", (node_id, ))
+database.delete_nodes(superfluous_node_ids)
 
 logger.info("Removed {} superfluous nodes".format(len(superfluous_node_ids)))
 
@@ -339,34 +197,19 @@ database.execute(
 # Identify any spurious results from the same spectrum.
 either, both = (3, 2.5) # sigma thresholds
 
-for wg in (1, ):
-
-    results = database.retrieve_table(
-        """ SELECT id, cname, node_id, teff, feh
-            FROM   results 
-            WHERE  passed_quality_control;""")
-    if results is None: continue
-
-    results = results.group_by("cname")
-    
-    spurious_results = []
-    for group in results.groups:
-
-        teff_sigmas = np.abs((np.nanmedian(group["teff"]) - group["teff"])/np.nanstd(group["teff"]))
-        feh_sigmas = np.abs((np.nanmedian(group["feh"]) - group["feh"])/np.nanstd(group["feh"]))
-
-        both_match = ((teff_sigmas > both) * (feh_sigmas > both))
-        either_match = ((teff_sigmas > either) + (feh_sigmas > either))
-        joint_match = both_match + either_match
-
-        if any(joint_match):
-            spurious_results.extend(group["id"][joint_match])
+spurious_results = quality.spurious_results(database, either=either, both=both,
+    cnames=cnames)
+if len(spurious_results) > 0:
+    database.execute(
+        """ UPDATE  results
+            SET     passed_quality_control = false
+            WHERE   id = ANY(%s)
+        """, ([int(result_id) for result_id in spurious_results], ))
 
-    if any(spurious_results):
-        database.execute(
-            """ UPDATE  results
-                SET     passed_quality_control = false
-                WHERE   id IN %s
-            """, (tuple(spurious_results), ))
+database.connection.commit()
 
+# Keep the aggregates consistent with the final quality control flags, and
+# remove the stars from the queue (unless they were queued again meanwhile).
+quality.refresh_aggregates(database, cnames)
+quality.clear_dirty_cnames(database, queued)
 database.connection.commit()
@@ -5,6 +5,7 @@
 import logging
 import numpy as np
 import psycopg2 as pg
+import sys
 import yaml
 from glob import glob
 
@@ -13,11 +14,13 @@ from glob import glob
 import os
 from astropy.io import fits
 
-from code import GESDatabase
+from code import GESDatabase, quality, schema, utils
+from code.gesdb import ingest_node_results_in_parallel
 
 
 db_filename = "db.yaml"
 nodes_filename = "nodes.yaml"
+adapters_filename = "adapters.yaml"
 schema_filename = "code/schema.sql"
 masterlist_filename = "fits-templates/masterlist/MasterGES_CoRoT_14Oct2016.fits"
 
@@ -29,13 +32,19 @@ with open(db_filename, "r") as fp:
 logger = logging.getLogger("ges")
 logger.info("Connected to database.")
 
-# Create the tables.
+# Create the tables, unless they already exist. Files that were ingested
+# previously (and have not changed) will be skipped, unless --rebuild is given.
 cursor = connection.cursor()
-logger.info("Creating tables from {}...".format(schema_filename))
-with open(schema_filename, "r") as fp:
-    cursor.execute(fp.read())
+cursor.execute("SELECT to_regclass('ingest_manifest')")
+if "--rebuild" in sys.argv[1:] or cursor.fetchone()[0] is None:
+    logger.info("Creating tables from {}...".format(schema_filename))
+    with open(schema_filename, "r") as fp:
+        cursor.execute(fp.read())
+    logger.info("Tables created.")
+
+else:
+    logger.info("Tables exist. Only new or changed files will be ingested.")
 cursor.close()
-logger.info("Tables created.")
 
 connection.commit()
 connection.close()
@@ -43,6 +52,9 @@ connection.close()
 # Create a database object.
 database = GESDatabase(**credentials)
 
+# Bring the schema up to date.
+schema.migrate(database)
+
 # Create nodes.
 with open(nodes_filename, "r") as fp:
     all_nodes = yaml.load(fp)
@@ -51,13 +63,22 @@ for wg, node_names in all_nodes.items():
     for node_name in node_names:
         node_id = database.create_or_retrieve_node_id(wg, node_name)
 
+# The parallel ingest workers use their own connections, so they can only see
+# nodes that have been committed.
+database.connection.commit()
+
 # Ingest the masterlist of spectra.
 N_ingested = database.ingest_spectra_masterlist(masterlist_filename)
 
 # Ingest results from the nodes.
-for filename in glob("node-results/*/*.fits"):
-    N = database.ingest_node_results(filename, extension=1)
-    logger.info("Ingested {} results from {}".format(N, filename))
+with open(adapters_filename, "r") as fp:
+    node_adapters = yaml.load(fp)
+
+# Each node file is loaded in its own process and transaction.
+ingest_summary = ingest_node_results_in_parallel(credentials,
+    glob("node-results/*/*.fits"), extension=1, adapters=node_adapters)
+if ingest_summary is not None:
+    ingest_summary.pprint(max_lines=-1, max_width=-1)
 
 database.connection.commit()
 
@@ -90,16 +111,18 @@ database.execute(
          WHERE ges_fld like 'GJ880%'""")
 
 # Some of the nodes did not keep the logg values from the masterlist file.
-masterlist = fits.open(masterlist_filename)
-for i in range(len(masterlist[1].data)):
-    cname = masterlist[1].data["CNAME"][i]
-    logg = masterlist[1].data["LOGG"][i]
-    e_logg = masterlist[1].data["E_LOGG"][i]
-    database.execute(
-        """ UPDATE results 
-            SET logg = %s, e_logg = %s 
-            WHERE cname = %s """, (float(logg), float(e_logg), cname))
+for block in utils.read_fits_blocks(masterlist_filename,
+    ("CNAME", "LOGG", "E_LOGG"), extension=1):
+    database.patch_from_reference("results", "cname", ("logg", "e_logg"),
+        (block["CNAME"], block["LOGG"].astype(float),
+            block["E_LOGG"].astype(float)), keep="last")
+
+database.connection.commit()
 
+# Refresh the quality control aggregates for the stars with new results, now
+# that all of the parallel ingests have been committed.
+queued_cnames = [cname for cname, marked in quality.dirty_cnames(database)]
+quality.refresh_aggregates(database, queued_cnames)
 database.connection.commit()
 
 # Remove superfluous fake nodes.
@@ -109,9 +132,8 @@ contributing_node_ids = database.retrieve_table(
         WHERE teff <> 'NaN'
     """)["node_id"]
 
-all_node_ids = database.retrieve_table("SELECT id FROM nodes")["id"]
-for node_id in set(all_node_ids).difference(contributing_node_ids):
-    database.execute("DELETE FROM nodes WHERE id = %s", (node_id, ))
+all_node_ids = database.node_registry[0].keys()
+database.delete_nodes(set(all_node_ids).difference(contributing_node_ids))
 
 database.connection.commit()
 
@@ -16,7 +16,8 @@ with open(db_filename, "r") as fp:
 database = GESDatabase(**credentials)
 
 # Produce a homogenised file.
-ship.homogenised_catalog(database,
-    "fits-templates/masterlist/MasterGES_CoRoT_14Oct2016.fits",
-    "outputs/ges-corot-homogenised.fits",
-    wg=1, overwrite=True)
+with database.query_scope("shipit"):
+    ship.homogenised_catalog(database,
+        "fits-templates/masterlist/MasterGES_CoRoT_14Oct2016.fits",
+        "outputs/ges-corot-homogenised.fits",
+        wg=1, overwrite=True)
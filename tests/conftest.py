@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules in code/ import each other by their top-level names.
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "code"))
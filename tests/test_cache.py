@@ -0,0 +1,87 @@
+""" Tests for the result cache and its parsing of SQL statements. """
+
+from astropy.table import Table
+
+import cache
+
+
+def test_written_tables_for_simple_statements():
+    assert cache.written_tables("INSERT INTO results (id) VALUES (1)") \
+        == set(["results"])
+    assert cache.written_tables("update ONLY public.Results SET teff = 1") \
+        == set(["results"])
+    assert cache.written_tables("DELETE FROM result_flags WHERE id = 1") \
+        == set(["result_flags"])
+    assert cache.written_tables("COPY spectra (cname) FROM STDIN") \
+        == set(["spectra"])
+    assert cache.written_tables("TRUNCATE TABLE dirty_cnames") \
+        == set(["dirty_cnames"])
+    assert cache.written_tables("DROP TABLE IF EXISTS _patch_results") \
+        == set(["_patch_results"])
+    assert cache.written_tables("SELECT * FROM results") == set()
+
+
+def test_written_tables_for_data_modifying_with_queries():
+    assert cache.written_tables(
+        """ WITH d AS (
+                DELETE FROM results WHERE ingest_id = 1 RETURNING cname),
+            i AS (
+                INSERT INTO result_flags (result_id) SELECT 1 RETURNING 1)
+            SELECT count(*) FROM d, i""") == set(["results", "result_flags"])
+
+    assert cache.written_tables(
+        """ WITH s AS (SELECT id FROM nodes WHERE wg = 11)
+            UPDATE results AS r
+               SET passed_quality_control = false
+              FROM s
+             WHERE r.node_id = s.id""") == set(["results"])
+
+
+def test_written_tables_ignores_clauses_that_are_not_targets():
+    assert cache.written_tables(
+        """ INSERT INTO dirty_cnames (cname) VALUES ('A')
+                ON CONFLICT (cname) DO UPDATE SET marked = clock_timestamp()
+            """) == set(["dirty_cnames"])
+    assert cache.written_tables(
+        "SELECT * FROM results FOR UPDATE OF results SKIP LOCKED") == set()
+    assert cache.written_tables(
+        "SELECT 'delete from spectra' FROM results -- update nodes") == set()
+
+
+def test_written_tables_for_functions():
+    assert cache.written_tables("SELECT mark_dirty_cnames(%s)") \
+        == set(["dirty_cnames"])
+    assert cache.written_tables("SELECT index_result_spectra(%s)") \
+        == set(["result_spectra"])
+    assert cache.written_tables("SELECT refresh_qc_aggregates(NULL)") \
+        == set(["spectrum_aggregates", "cname_aggregates"])
+
+
+def test_is_read_only():
+    assert cache.is_read_only("SELECT id FROM results")
+    assert cache.is_read_only(
+        """ WITH RECURSIVE c (cname) AS (
+                SELECT unnest(%s::text[]) UNION SELECT cname FROM results)
+            SELECT cname FROM c""")
+    assert not cache.is_read_only("SELECT mark_dirty_cnames(%s)")
+    assert not cache.is_read_only(
+        "WITH d AS (DELETE FROM results RETURNING id) SELECT id FROM d")
+    assert not cache.is_read_only("SELECT id FROM results FOR UPDATE")
+    assert not cache.is_read_only("SELECT id FROM results FOR KEY SHARE")
+    assert not cache.is_read_only("EXPLAIN SELECT id FROM results")
+    assert not cache.is_read_only("")
+
+
+def test_cached_results_are_invalidated_by_writes():
+    results = cache.ResultCache(10**6)
+    query = "SELECT id FROM results"
+    versions = results.versions(query)
+    results.put("key", Table(rows=[(1, )], names=("id", )), versions)
+    assert results.get("key") is not None
+
+    results.invalidate("UPDATE spectra SET teff_irfm = 1")
+    assert results.get("key") is not None
+
+    results.invalidate(
+        "WITH s AS (SELECT 1) UPDATE results SET teff = 1 FROM s")
+    assert results.get("key") is None
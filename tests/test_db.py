@@ -0,0 +1,135 @@
+""" Tests for the convenience database object that do not need a server. """
+
+import threading
+
+import numpy as np
+import pytest
+
+import db
+
+
+class FakeCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def copy_expert(self, query, buffer):
+        self.connection.copied.append((query, buffer.getvalue()))
+        self.rowcount = buffer.getvalue().count("\n")
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.copied = []
+
+    def cursor(self, *args, **kwargs):
+        return FakeCursor(self)
+
+
+def _database():
+    """ A `Database` with a fake connection, which records what is copied. """
+
+    database = db.Database.__new__(db.Database)
+    database.queries = None
+    database.results = None
+    database._local = threading.local()
+    database._pool = None
+    database._connection = FakeConnection()
+    return database
+
+
+def test_format_copy_column_floats():
+    values = np.array([0.1, -2.5, 1e-300, 123456789.123456789, np.nan])
+    formatted = db._format_copy_column(values)
+
+    assert list(map(float, formatted[:4])) == list(values[:4])
+    assert formatted[4].lower() == "nan"
+
+
+def test_format_copy_column_integers_and_booleans():
+    assert list(db._format_copy_column(np.array([0, -3, 2**40]))) \
+        == ["0", "-3", str(2**40)]
+    assert list(db._format_copy_column(np.array([True, False]))) == ["t", "f"]
+
+
+def test_format_copy_column_escapes_strings():
+    values = np.array(["plain", "tab\there", "new\nline", "back\\slash",
+        "carriage\rreturn"])
+    assert list(db._format_copy_column(values)) == ["plain", "tab\\there",
+        "new\\nline", "back\\\\slash", "carriage\\rreturn"]
+
+
+def test_format_copy_column_nulls():
+    masked = np.ma.array([1.5, 2.5, 3.5], mask=[False, True, False])
+    assert list(db._format_copy_column(masked)) == ["1.5", "\\N", "3.5"]
+
+    objects = np.array(["a", None, 3], dtype=object)
+    assert list(db._format_copy_column(objects)) == ["a", "\\N", "3"]
+
+
+def test_copy_from_writes_tab_separated_rows():
+    database = _database()
+    N = database.copy_from("results", ("cname", "teff", "nn_teff"), [
+        np.array(["A", "B\tC"]),
+        np.ma.array([5000.5, 0], mask=[False, True]),
+        np.array([3, 4])])
+
+    assert N == 2
+    query, copied = database._connection.copied[0]
+    assert query == "COPY results (cname, teff, nn_teff) FROM STDIN"
+    assert copied == "A\t5000.5\t3\nB\\tC\t\\N\t4\n"
+
+
+def test_copy_from_checks_number_of_columns():
+    with pytest.raises(ValueError):
+        _database().copy_from("results", ("cname", "teff"), [["A"]])
+
+
+class FakeResultCursor(object):
+
+    def __init__(self, description, rows):
+        self.description = description
+        self.rowcount = len(rows)
+        self._rows = list(rows)
+        self.fetched = []
+
+    def fetchmany(self, size):
+        rows, self._rows = (self._rows[:size], self._rows[size:])
+        self.fetched.append(len(rows))
+        return rows
+
+
+def test_fetch_arrays_fills_typed_columns_in_batches():
+    description = [("teff", 701), ("nn_teff", 23), ("cname", 25),
+        ("passed_quality_control", 16), ("snr", 1700)]
+    rows = [(5000.0, 3, "A", True, 10.5), (None, 4, "B", False, None),
+        (5100.0, 5, "C", True, 20.0)]
+    cursor = FakeResultCursor(description, rows)
+
+    teff, nn_teff, cname, passed, snr = db._fetch_arrays(cursor, batch_size=2)
+
+    assert cursor.fetched == [2, 1, 0]
+    assert teff.dtype == float and np.isnan(teff[1])
+    assert list(teff[[0, 2]]) == [5000.0, 5100.0]
+    assert nn_teff.dtype == np.int64 and list(nn_teff) == [3, 4, 5]
+    assert cname.dtype.kind in "SU" and list(cname) == ["A", "B", "C"]
+    assert passed.dtype == bool and list(passed) == [True, False, True]
+    assert snr.dtype == float and np.isnan(snr[1])
+
+
+def test_fetch_arrays_keeps_nulls_in_integer_and_boolean_columns():
+    description = [("nn_teff", 23), ("passed_quality_control", 16)]
+    rows = [(3, True), (None, None)]
+
+    nn_teff, passed = db._fetch_arrays(FakeResultCursor(description, rows))
+
+    assert list(nn_teff) == [3, None]
+    assert list(passed) == [True, None]
@@ -0,0 +1,60 @@
+""" Tests for the sparse in-memory flag index. """
+
+import numpy as np
+import pytest
+
+from flagindex import FlagIndex
+
+
+def _index():
+    # Result 30 has no flags, and result 10 is given 'b' twice.
+    return FlagIndex([10, 20, 30, 40], [40, 10, 10, 20, 10, 40],
+        ["a", "b", "a", "c", "b", "c"], cnames=["A", "A", "B", "C"],
+        node_ids=[1, 2, 1, 2])
+
+
+def test_flags_are_coded_in_sorted_order():
+    index = _index()
+    assert len(index) == 4
+    assert list(index.flags) == ["a", "b", "c"]
+    assert [index.code(flag) for flag in ("a", "b", "c")] == [0, 1, 2]
+    assert index.code("d") is None
+    assert index.code("0") is None
+
+
+def test_mask_and_rows_with():
+    index = _index()
+    assert list(index.mask("a")) == [True, False, False, True]
+    assert list(index.rows_with("b")) == [10]
+    assert list(index.rows_with("c")) == [20, 40]
+    assert not np.any(index.mask("d"))
+
+
+def test_counts_each_row_once():
+    index = _index()
+    assert list(index.counts()) == [2, 1, 2]
+    assert list(index.counts(index.node_ids == 2)) == [1, 0, 2]
+
+
+def test_cooccurrence():
+    matrix = _index().cooccurrence().toarray()
+    assert np.all(matrix == matrix.T)
+    assert list(np.diag(matrix)) == [2, 1, 2]
+    assert matrix[0, 1] == 1 and matrix[0, 2] == 1 and matrix[1, 2] == 0
+
+
+def test_without_flags():
+    index = FlagIndex([1, 2], [], [])
+    assert len(index) == 2
+    assert index.flags.size == 0
+    assert list(index.counts()) == []
+    assert not np.any(index.mask("a"))
+
+    assert len(FlagIndex([], [], [])) == 0
+
+
+def test_flags_for_rows_that_are_not_indexed():
+    with pytest.raises(ValueError):
+        FlagIndex([1, 2], [3], ["a"])
+    with pytest.raises(ValueError):
+        FlagIndex([], [1], ["a"])
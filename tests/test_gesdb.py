@@ -0,0 +1,29 @@
+""" Tests for the Gaia-ESO Survey database helpers that do not need a server. """
+
+import numpy as np
+import pytest
+
+from gesdb import _unique_key_rows
+
+
+def test_keep_last():
+    keys = ["a", "b", "a", "c", "b"]
+    assert list(_unique_key_rows(keys)) == [2, 3, 4]
+    assert list(_unique_key_rows(keys, keep="last")) == [2, 3, 4]
+
+
+def test_keep_first():
+    keys = ["a", "b", "a", "c", "b"]
+    assert list(_unique_key_rows(keys, keep="first")) == [0, 1, 3]
+
+
+def test_unique_keys_are_all_kept_in_order():
+    keys = np.array([30, 10, 20])
+    for keep in ("first", "last"):
+        assert list(_unique_key_rows(keys, keep=keep)) == [0, 1, 2]
+    assert _unique_key_rows([], keep="first").size == 0
+
+
+def test_unknown_keep():
+    with pytest.raises(ValueError):
+        _unique_key_rows(["a"], keep="both")
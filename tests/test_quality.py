@@ -0,0 +1,79 @@
+""" Tests for the vectorised quality control checks. """
+
+import numpy as np
+
+import quality
+
+
+def _reference_sigmas(cnames, values):
+    """ The per-star sigmas, computed one star at a time. """
+
+    cnames, values = (np.asarray(cnames), np.asarray(values, dtype=float))
+    sigmas = np.nan * np.ones(values.size)
+    for cname in np.unique(cnames):
+        match = (cnames == cname)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sigmas[match] = np.abs(np.nanmedian(values[match]) - values[match])\
+                          / np.nanstd(values[match])
+    return sigmas
+
+
+def test_group_sigmas_matches_per_star_loop():
+    rng = np.random.RandomState(42)
+    cnames = rng.choice(["A", "B", "C", "D"], size=200)
+    values = rng.normal(5000, 200, size=cnames.size)
+    values[::17] = np.nan
+
+    unique_cnames, codes = np.unique(cnames, return_inverse=True)
+    sigmas = quality._group_sigmas(codes, values, len(unique_cnames))
+
+    expected = _reference_sigmas(cnames, values)
+    assert np.all(np.isfinite(sigmas) == np.isfinite(expected))
+    finite = np.isfinite(expected)
+    assert np.allclose(sigmas[finite], expected[finite])
+
+
+def test_group_sigmas_with_even_and_single_groups():
+    codes = np.array([0, 0, 0, 0, 1])
+    values = np.array([1.0, 2.0, 3.0, 10.0, 7.0])
+
+    sigmas = quality._group_sigmas(codes, values, 2)
+
+    assert np.allclose(sigmas[:4], _reference_sigmas(codes[:4], values[:4]))
+    # A single result has no scatter.
+    assert not np.isfinite(sigmas[4])
+
+
+def test_find_spurious_results_either_parameter():
+    ids = np.arange(40)
+    cnames = np.repeat(["A", "B"], 20)
+    teff = np.tile(np.linspace(4900, 5100, 20), 2)
+    feh = np.tile(np.linspace(-0.1, 0.1, 20), 2)
+    teff[3] = 8000
+    feh[25] = -3
+
+    spurious = quality.find_spurious_results(ids, cnames, teff, feh)
+    assert sorted(spurious) == [3, 25]
+
+
+def test_find_spurious_results_both_parameters():
+    ids = np.arange(100)
+    cnames = np.array(["A"] * 100)
+    teff = np.linspace(4900, 5100, 100)
+    feh = np.linspace(-0.1, 0.1, 100)
+
+    # Between 2.5 and 3 sigma in both parameters, but not 3 in either.
+    teff[0] = 5000 - 2.8 * np.std(teff)
+    feh[0] = -2.8 * np.std(feh)
+    teff_sigma = _reference_sigmas(cnames, teff)[0]
+    feh_sigma = _reference_sigmas(cnames, feh)[0]
+    assert 2.5 < teff_sigma < 3 and 2.5 < feh_sigma < 3
+
+    assert list(quality.find_spurious_results(ids, cnames, teff, feh)) == [0]
+    assert len(quality.find_spurious_results(ids, cnames, teff, feh,
+        both=3)) == 0
+
+
+def test_find_spurious_results_without_results():
+    spurious = quality.find_spurious_results([], [], [], [])
+    assert len(spurious) == 0
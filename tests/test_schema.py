@@ -0,0 +1,49 @@
+""" Tests for finding the schema migrations. """
+
+import os
+
+import pytest
+
+import schema
+
+
+def _touch(path, filename):
+    with open(os.path.join(path, filename), "w") as fp:
+        fp.write("SELECT 1;\n")
+    return os.path.join(path, filename)
+
+
+def test_migrations_are_ordered_by_version(tmpdir):
+    path = str(tmpdir)
+    second = _touch(path, "0010_second.sql")
+    first = _touch(path, "0002_first.sql")
+
+    assert schema.available_migrations(path) == [
+        (2, "first", first),
+        (10, "second", second)
+    ]
+
+
+def test_unexpected_files_are_ignored(tmpdir):
+    path = str(tmpdir)
+    first = _touch(path, "0001_first.sql")
+    _touch(path, "notes.sql")
+    _touch(path, "0002-dashes.sql")
+    _touch(path, "0003_not_sql.txt")
+
+    assert schema.available_migrations(path) == [(1, "first", first)]
+
+
+def test_duplicate_versions(tmpdir):
+    path = str(tmpdir)
+    _touch(path, "0001_first.sql")
+    _touch(path, "1_again.sql")
+
+    with pytest.raises(ValueError):
+        schema.available_migrations(path)
+
+
+def test_shipped_migrations():
+    migrations = schema.available_migrations()
+    versions = [version for version, name, filename in migrations]
+    assert versions == list(range(1, 1 + len(versions)))